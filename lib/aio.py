@@ -0,0 +1,86 @@
+"""
+An asyncio event loop running the bot`s handlers in a background thread
+"""
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+
+from lib.logger import get_logger
+
+
+class AsyncRunner:
+    """
+    Runs coroutines on an event loop in a dedicated thread.
+    Blocking calls (e.g. Telegram API requests) are awaited on a bounded
+    thread pool, so a handler holds a thread only while a request is in flight.
+    """
+
+    def __init__(self, io_workers: int = 16):
+        """
+        Keyword arguments:
+        io_workers -- maximum number of blocking calls running at the same time
+        """
+        self.log = get_logger()
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(io_workers, thread_name_prefix="AsyncIO")
+        self.loop.set_default_executor(self.executor)
+        self.thread = None
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Start the event loop thread
+        """
+        self.thread = threading.Thread(
+            target=self.run, name="AsyncRunner", daemon=True
+        )
+        self.thread.start()
+
+    def run(self) -> None:
+        """
+        The event loop thread
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        """
+        Schedule a coroutine from any thread, return a concurrent future
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future: Future) -> None:
+        """
+        Forget a finished coroutine and log its exception
+        """
+        with self.lock:
+            self.pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            self.log.error("unhandled exception", exc_info=future.exception())
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Await a blocking function on the thread pool
+        """
+        return await self.loop.run_in_executor(
+            self.executor, partial(fn, *args, **kwargs)
+        )
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """
+        Wait for scheduled coroutines and stop the event loop
+        """
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending, timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown(wait=True)
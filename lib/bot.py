@@ -1,14 +1,33 @@
 """
 The bot's main logic
 """
+import asyncio
 import json
-
-from telegram import ReplyKeyboardMarkup, Update
-from telegram.ext import (CallbackContext, CommandHandler, ConversationHandler,
+import signal
+import socket
+import ssl
+import threading
+from contextlib import nullcontext
+from time import time
+
+from telegram import InputMediaPhoto, ReplyKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.ext import (CallbackContext, ConversationHandler, ExtBot,
                           Filters, MessageHandler, Updater)
 
-from lib.logger import LOGGER_NAME, Logger, get_logger, trace
+from lib.aio import AsyncRunner
+from lib.catalog import PracticeCatalog, read_manifest, validate_theory
+from lib.cleanup import MessageCleaner
+from lib.logger import (LOGGER_NAME, Logger, configure_trace, dump_trace_stats,
+                        get_logger, trace)
+from lib.media import FileIdCache, MediaWarmer
+from lib.metrics import MetricsServer, Registry
+from lib.outbound import REPLY, OutboundScheduler
 from lib.practice import Practice
+from lib.request import PooledRequest, required_pool_size
+from lib.scheduler import ChatScheduler
+from lib.session import ActiveUsers, ChatStates, SessionCache
+from lib.storage import create_storage
 from lib.user import UserManager
 
 
@@ -30,13 +49,18 @@ class Bot:
         SETTINGS,
     ) = range(9)
 
-    def __init__(self):
+    def __init__(self, settings: dict = None):
+        """
+        Keyword arguments:
+        settings -- the bot`s config, loaded from config/settings.json if not given
+        """
         self.bot = None
-        self.session_manager = {}
+        self.updater = None
         # load json config
-        self.settings = None
-        with open("./config/settings.json", "r") as f:
-            self.settings = json.load(f)
+        self.settings = settings
+        if self.settings is None:
+            with open("./config/settings.json", "r") as f:
+                self.settings = json.load(f)
 
         # init logger
         self.logger = Logger(
@@ -48,59 +72,289 @@ class Bot:
             self.settings["logger"]["backup_count"],
             self.settings["logger"]["name_date_format"],
             LOGGER_NAME,
+            self.settings["logger"].get("queue", True),
+            self.settings["logger"].get("json", False),
+            self.settings["logger"].get("rate_limit", 0),
+            self.settings["logger"].get("rate_interval", 60),
         )
 
         self.log = get_logger()
 
+        # runtime metrics, served over HTTP if enabled in the config
+        self.metrics = Registry()
+        self.metrics_server = None
+
+        # all Telegram API requests are sent within Telegram`s rate limits
+        outbound_settings = self.settings.get("outbound", {})
+        self.outbound = OutboundScheduler(
+            outbound_settings.get("rate", 30),
+            outbound_settings.get("burst", 30),
+            outbound_settings.get("chat_rate", 1),
+            outbound_settings.get("chat_burst", 10),
+            outbound_settings.get("max_retries", 3),
+            metrics=self.metrics,
+        )
+
+        # users` profiles are written in the background
+        storage_settings = self.settings.get("storage", {})
+        self.user_manager = UserManager(
+            create_storage(storage_settings),
+            storage_settings.get("flush_interval", 5.0),
+            storage_settings.get("flush_threshold", 100),
+        )
+
+        # active chats` sessions, loaded on demand; changed users are already
+        # queued for writing, so an evicted session needs no saving
+        session_settings = self.settings.get("sessions", {})
+        self.session_manager = SessionCache(
+            self.load_session,
+            max_size=session_settings.get("max_size", 10000),
+            idle_ttl=session_settings.get("idle_ttl", 3600),
+        )
+        # sessions of recently active users are loaded ahead of their messages
+        self.active_users = ActiveUsers(
+            session_settings.get("active_users", "cache/active_users.json"),
+            session_settings.get("max_size", 10000) * 10,
+        )
+        self.preload_max_age = session_settings.get("preload_max_age", 86400)
+        self.preload_limit = session_settings.get("preload", 1000)
+        self.preloader = None
+        self.stopping = threading.Event()
+
+        # all practice items with their assets urls
+        self.catalog = PracticeCatalog(self.settings["HOST"])
+        for problem in validate_theory():
+            self.log.error(f"practice catalog: {problem}")
+
+        # pick practice items by the user`s error rate instead of uniformly
+        self.adaptive = self.settings.get("practice", {}).get("adaptive", True)
+
+        # telegram file ids of already sent practice media
+        media_settings = self.settings.get("media", {})
+        self.file_ids = FileIdCache(
+            media_settings.get("file_ids", "cache/file_ids.json"),
+            str(media_settings.get("version", "")),
+        )
+        # the next practice question is prepared while the user reads the answer
+        self.prefetch = media_settings.get("prefetch", True)
+        self.warmer = None
+        if media_settings.get("warm", True):
+            self.warmer = MediaWarmer(
+                media_settings.get("warm_timeout", 5.0),
+                workers=media_settings.get("warm_workers", 2),
+            )
+
+        # assets found missing on HOST by tools/check_assets.py are not used
+        manifest = read_manifest(media_settings.get("manifest", "cache/assets.json"))
+        if manifest is not None and self.catalog.apply_manifest(manifest):
+            self.file_ids.sync_etags(manifest.get("etags", {}))
+
+        # chat messages are deleted in the background
+        cleanup_settings = self.settings.get("cleanup", {})
+        self.cleaner = MessageCleaner(
+            None,
+            cleanup_settings.get("workers", 4),
+            cleanup_settings.get("bulk", True),
+            outbound=self.outbound,
+        )
+
+        # handlers are coroutines on an event loop, blocking calls run on a pool
+        updates_settings = self.settings.get("updates", {})
+        self.aio = AsyncRunner(updates_settings.get("io_workers", 16))
+        self.scheduler = ChatScheduler(updates_settings.get("max_concurrency", 64))
+        # chats` conversation states, kept apart from the sessions: a chat
+        # continues in its state when its session is evicted and reloaded
+        self.chat_states = ChatStates(self.active_users.max_size)
+        self.handlers = {
+            self.MENU: self.menu,
+            self.PRACTICE_MENU: self.practice_menu,
+            self.PRE_ACTION: self.pre_action,
+            self.PRACTICE: self.practice,
+            self.PRACTICE_RESPONSE: self.practice_response,
+            self.STATS: self.stats,
+            self.SETTINGS: self.settings_action,
+        }
+        # states names for metrics labels, None is a new or a cancelled chat
+        self.state_names = {None: "START"}
+        for name in (
+            "MENU",
+            "ABOUT",
+            "PRACTICE_RESPONSE",
+            "PRACTICE",
+            "STATS",
+            "PRE_ACTION",
+            "PRACTICE_MENU",
+            "SETTINGS_MENU",
+            "SETTINGS",
+        ):
+            self.state_names[getattr(self, name)] = name
+        self.register_metrics()
+
+        # tracing is off unless enabled in the config
+        trace_settings = self.settings.get("trace", {})
+        configure_trace(
+            trace_settings.get("enabled", False),
+            trace_settings.get("sample_rate", 1),
+            trace_settings.get("log_args", False),
+        )
+
+    def register_metrics(self) -> None:
+        """
+        Handlers latency, sessions, queues and storage metrics
+        """
+        self.handler_latency = self.metrics.histogram(
+            "handler_seconds", "Update handling latency by chat state", ("state",)
+        )
+        self.metrics.gauge_fn(
+            "sessions", "Chats sessions in memory", lambda: len(self.session_manager)
+        )
+        self.metrics.gauge_fn(
+            "chat_states",
+            "Chats with a conversation state",
+            lambda: len(self.chat_states),
+        )
+        self.metrics.gauge_fn(
+            "updates_waiting",
+            "Updates waiting for a previous update of the chat or a free slot",
+            lambda: self.scheduler.waiting,
+        )
+        self.metrics.gauge_fn(
+            "updates_running", "Updates being handled", lambda: self.scheduler.running
+        )
+        self.metrics.gauge_fn(
+            "loop_tasks", "Tasks on the event loop", lambda: len(self.aio.pending)
+        )
+        self.metrics.gauge_fn(
+            "dispatcher_queue",
+            "Updates received but not dispatched yet",
+            lambda: self.updater.dispatcher.update_queue.qsize() if self.updater else 0,
+        )
+        self.metrics.gauge_fn(
+            "storage_dirty",
+            "Users with changes not written yet",
+            lambda: len(self.user_manager.dirty),
+        )
+        self.metrics.counter_fn(
+            "storage_writes_total",
+            "Users changes written to the storage",
+            lambda: self.user_manager.written,
+        )
+        self.metrics.counter_fn(
+            "storage_flushes_total",
+            "Flushes of users changes",
+            lambda: self.user_manager.flushes,
+        )
+        self.metrics.gauge_fn(
+            "file_ids", "Cached telegram file ids", lambda: len(self.file_ids.files)
+        )
+
+    @trace
+    def load_session(self, chat_id: int) -> dict:
+        """
+        Create a chat session for a stored or a new user
+        """
+        return {
+            "user": self.user_manager.load_user(chat_id),
+            "msg_ids": {},
+            "loc": "start",
+            "practice": None,
+            "pm": None,
+            "pi": None,
+            "next": None,
+        }
+
+    @trace
+    def on_update(self, update: Update, context: CallbackContext) -> None:
+        """
+        Pass an update from the dispatcher thread to the event loop,
+        updates of a chat are handled one by one in order
+        """
+        self.active_users.touch(update.message.chat_id)
+        self.aio.submit(
+            self.scheduler.run(
+                update.message.chat_id, self.handle_update(update, context)
+            )
+        )
+
+    @trace
+    async def handle_update(self, update: Update, context: CallbackContext) -> None:
+        """
+        Route a message to the handler of the chat`s current state
+        """
+        # a session may have to be loaded from the storage
+        chat_id = update.message.chat_id
+        await self.aio.call(self.session_manager.__getitem__, chat_id)
+        state = self.chat_states.get(chat_id)
+        text = update.message.text or ""
+        if text.startswith("/cancel"):
+            # stops the chat in any state
+            handler = self.cancel
+        elif state is None:
+            # a new or a cancelled chat
+            if text.startswith("/start"):
+                handler = self.start
+            else:
+                handler = self.pre_action
+        else:
+            handler = self.handlers[state]
+
+        with self.handler_latency.time(self.state_names.get(state, state)):
+            state = await handler(update, context)
+        self.chat_states.set(
+            chat_id, None if state == ConversationHandler.END else state
+        )
+
+    async def api(self, fn, *args, **kwargs):
+        """
+        Await a blocking Telegram API call of a reply to a chat,
+        either a message`s method or a bot`s method with a chat id first
+        """
+        chat_id = getattr(getattr(fn, "__self__", None), "chat_id", None)
+        if chat_id is None and args:
+            chat_id = args[0]
+        return await self.outbound.call_async(
+            self.aio.call, chat_id, REPLY, fn, *args, **kwargs
+        )
+
     @trace
     def cleanup_messages(self, chat_id: int) -> None:
         """
-        Delete selected messages from a chat
+        Delete selected messages from a chat in the background
         """
-        self.log.debug("cleanup ids: {}".format(self.session_manager[chat_id]["msg_ids"]))
-        for i in self.session_manager[chat_id]["msg_ids"]:
-            try:
-                self.bot.delete_message(chat_id, i)
-            except Exception as e:
-                self.log.exception(f"msg_id {i}, ex:\n{e}")
-        self.session_manager[chat_id]["msg_ids"] = []
+        s = self.session_manager[chat_id]
+        msg_ids, s["msg_ids"] = s["msg_ids"], {}
+        self.log.debug("cleanup ids: {}".format(list(msg_ids)))
+        self.cleaner.delete(chat_id, msg_ids)
 
     @trace
     def remove_msg(self, chat_id: int, msg_id: int) -> None:
         """
         Add a message to into "to delete" list
         """
-        if msg_id not in self.session_manager[chat_id]["msg_ids"]:
-            self.session_manager[chat_id]["msg_ids"].append(msg_id)
+        self.session_manager[chat_id]["msg_ids"].setdefault(msg_id, time())
 
     @trace
-    def start(self, update: Update, context: CallbackContext) -> int:
+    async def start(self, update: Update, context: CallbackContext) -> int:
         """
         The entry point for the chat
         """
         self.log.info("start {}".format(update.message.chat_id))
 
         # load user information
-        if update.message.chat_id not in self.session_manager:
-            um = UserManager()
-            user = um.load_user(update.message.chat_id)
-            self.session_manager[update.message.chat_id] = {
-                "user": user,
-                "msg_ids": [],
-                "loc": "start",
-                "practice": None,
-            }
+        self.session_manager[update.message.chat_id]["loc"] = "start"
 
         self.log.info(
             f"userid: {update.message.from_user.id}, username: {update.message.from_user.username}"
         )
 
-        update.message.reply_text("Welcome to Music Learning and Practice Bot!\n")
+        await self.api(
+            update.message.reply_text, "Welcome to Music Learning and Practice Bot!\n"
+        )
 
-        return self.menu(update, context)
+        return await self.menu(update, context)
 
     @trace
-    def pre_process(
+    async def pre_process(
         self,
         update: Update,
         loc: str,
@@ -123,7 +377,7 @@ class Bot:
             self.remove_msg(update.message.chat_id, update.message.message_id)
 
     @trace
-    def post_process(
+    async def post_process(
         self, update: Update, kb_text: str, kb_items: list, remove_msg: bool = True
     ) -> None:
         """
@@ -134,7 +388,8 @@ class Bot:
             f"post_process({update.message.chat_id}, {kb_text}, {kb_items}, {remove_msg})"
         )
 
-        msg = update.message.reply_text(
+        msg = await self.api(
+            update.message.reply_text,
             kb_text,
             reply_markup=ReplyKeyboardMarkup(
                 kb_items, one_time_keyboard=True, resize_keyboard=True
@@ -145,27 +400,78 @@ class Bot:
             self.remove_msg(update.message.chat_id, msg.message_id)
 
     @trace
-    def send_image(self, chat_id: int, url: str) -> None:
+    async def send_media(self, chat_id: int, url: str, kind: str) -> None:
+        """
+        Send a media (photo or audio) to the chat,
+        reuse a cached file id of the url if there is one
+        """
+        send = self.bot.send_photo if kind == "photo" else self.bot.send_audio
+        file_id = self.file_ids.get(url)
+        try:
+            msg = await self.api(send, chat_id, file_id or url)
+        except BadRequest as e:
+            if file_id is None:
+                raise
+            self.log.warning(f"cached file id of {url} failed: {e}")
+            self.file_ids.invalidate(url)
+            msg = await self.api(send, chat_id, url)
+
+        media = getattr(msg, kind)
+        if media:
+            # a photo comes in several sizes, the largest one is the last
+            media = media[-1] if kind == "photo" else media
+            self.file_ids.set(url, media.file_id)
+        self.remove_msg(chat_id, msg.message_id)
+
+    @trace
+    async def send_image(self, chat_id: int, url: str) -> None:
         """
         Send an image url to the chat
         """
-        msg = self.bot.send_photo(chat_id=chat_id, photo=url)
-        self.remove_msg(chat_id, msg.message_id)
+        await self.send_media(chat_id, url, "photo")
 
     @trace
-    def send_audio(self, chat_id: int, url: str) -> None:
+    async def send_images(self, chat_id: int, urls: list) -> None:
+        """
+        Send image urls to the chat as a single media group
+        """
+        if len(urls) < 2:
+            for url in urls:
+                await self.send_image(chat_id, url)
+            return
+
+        file_ids = [self.file_ids.get(url) for url in urls]
+        media = [InputMediaPhoto(f or url) for f, url in zip(file_ids, urls)]
+        try:
+            msgs = await self.api(self.bot.send_media_group, chat_id, media)
+        except BadRequest as e:
+            if not any(file_ids):
+                raise
+            self.log.warning(f"cached file ids of {urls} failed: {e}")
+            for url, file_id in zip(urls, file_ids):
+                if file_id is not None:
+                    self.file_ids.invalidate(url)
+            media = [InputMediaPhoto(url) for url in urls]
+            msgs = await self.api(self.bot.send_media_group, chat_id, media)
+
+        for url, msg in zip(urls, msgs):
+            if msg.photo:
+                self.file_ids.set(url, msg.photo[-1].file_id)
+            self.remove_msg(chat_id, msg.message_id)
+
+    @trace
+    async def send_audio(self, chat_id: int, url: str) -> None:
         """
         Send an audio url to the chat
         """
-        msg = self.bot.send_audio(chat_id=chat_id, audio=url)
-        self.remove_msg(chat_id, msg.message_id)
+        await self.send_media(chat_id, url, "audio")
 
     @trace
-    def pre_action(self, update: Update, context: CallbackContext) -> int:
+    async def pre_action(self, update: Update, context: CallbackContext) -> int:
         """
         Peform specific actions before handling user input and ui
         """
-        self.pre_process(update, "pre_action", True, True)
+        await self.pre_process(update, "pre_action", True, True)
 
         proxies = {
             "STATS": self.stats,
@@ -174,18 +480,18 @@ class Bot:
             "BACK": self.settings_menu,
         }
         if update.message.text in proxies:
-            return proxies[update.message.text](update, context)
-        return self.menu(update, context)
+            return await proxies[update.message.text](update, context)
+        return await self.menu(update, context)
 
     @trace
-    def practice_menu(self, update: Update, context: CallbackContext) -> int:
+    async def practice_menu(self, update: Update, context: CallbackContext) -> int:
         """
         The practice menu handler
         """
-        self.pre_process(update, "p_menu", False, False)
+        await self.pre_process(update, "p_menu", False, False)
 
         # TODO: add 'KEYS' and 'INTERVALS'
-        self.post_process(
+        await self.post_process(
             update,
             "Practice Menu:\n\nNote: go to SETTINGS to setup your practice.",
             [["MODES", "CHORDS", "MENU"]],
@@ -193,53 +499,73 @@ class Bot:
         return self.PRACTICE
 
     @trace
-    def practice(self, update: Update, context: CallbackContext) -> int:
+    async def practice(self, update: Update, context: CallbackContext) -> int:
         """
         The practice (chords and modes) handler
         """
-        self.pre_process(update, "p", False, False)
+        await self.pre_process(update, "p", False, False)
 
         if update.message.text == "MENU":
-            return self.pre_action(update, context)
+            return await self.pre_action(update, context)
 
         # TODO : Can we remove the message in pre_process for ^^^ MENU ???
         self.remove_msg(update.message.chat_id, update.message.message_id)
 
         s = self.session_manager[update.message.chat_id]
         if update.message.text == "NEXT":
+            if s["practice"] is None:
+                # the session was evicted and reloaded
+                return await self.practice_menu(update, context)
             update.message.text = s["practice"]
         if update.message.text in ["CHORDS", "MODES"]:
             s["practice"] = update.message.text
-            s["user"].settings.data["HOST"] = self.settings["HOST"]
-            s["pm"] = Practice(s["user"].settings, update.message.text)
+            if s["pm"] is None or s["pm"].item_type != s["practice"]:
+                s["pm"] = Practice(
+                    s["user"].settings,
+                    s["practice"],
+                    self.catalog,
+                    s["user"].stats if self.adaptive else None,
+                )
         else:
             raise NotImplementedError
 
-        s["pi"] = s["pm"].generate()
-
-        self.send_audio(update.message.chat_id, s["pi"].url_audio)
+        # a question prepared after the previous answer, if it is still valid
+        prepared, s["next"] = s["next"], None
+        if prepared is not None and prepared.p_type == s["practice"]:
+            s["pi"] = prepared
+        else:
+            s["pi"] = s["pm"].generate()
 
-        self.post_process(
-            update,
-            f"Please listen and guess the {s['practice'].lower()[:-1]} (in {s['pi'].scale_text})\n",
-            [s["pi"].keyboard],
+        # the audio and the answers keyboard are sent at the same time
+        await asyncio.gather(
+            self.send_audio(update.message.chat_id, s["pi"].url_audio),
+            self.post_process(
+                update,
+                f"Please listen and guess the {s['practice'].lower()[:-1]} (in {s['pi'].scale_text})\n",
+                [s["pi"].keyboard],
+            ),
         )
         return self.PRACTICE_RESPONSE
 
     @trace
-    def practice_response(self, update: Update, context: CallbackContext) -> int:
+    async def practice_response(self, update: Update, context: CallbackContext) -> int:
         """
         Handle a user`s reponce for a give practice item
         """
-        self.pre_process(update, "p_resp", True, True)
+        await self.pre_process(update, "p_resp", True, True)
         s = self.session_manager[update.message.chat_id]
+        if s["pi"] is None:
+            # the session was evicted and reloaded
+            return await self.practice_menu(update, context)
 
+        images = []
         # display music notation
-        if 0 in s["user"].settings.data["display"]:
-            self.send_image(update.message.chat_id, s["pi"].url_img2)
+        if s["user"].settings.selected("display", 0):
+            images.append(s["pi"].url_img2)
         # display piano keyboard
-        if 1 in s["user"].settings.data["display"]:
-            self.send_image(update.message.chat_id, s["pi"].url_img)
+        if s["user"].settings.selected("display", 1):
+            images.append(s["pi"].url_img)
+        images = [url for url in images if self.catalog.exists(url)]
 
         item = ""
         if s["practice"] == "CHORDS":
@@ -252,31 +578,51 @@ class Bot:
             )
 
         result = s["pi"].answer_text == update.message.text
-        s["user"].stats.result(
-            result, s["practice"].lower(), s["pi"].answer_text, s["pi"].answer2_text
+        self.user_manager.record_answer(
+            update.message.chat_id,
+            s["user"],
+            result,
+            s["practice"].lower(),
+            s["pi"].answer,
+            s["pi"].answer2,
         )
 
-        um = UserManager()
-        um.save_user(update.message.chat_id, s["user"])
-
-        self.post_process(
-            update,
-            f"Correct! {item}" if result else f"No, that was {item}",
-            [["NEXT"], ["MENU"]],
+        # the images and the verdict are sent at the same time
+        await asyncio.gather(
+            self.send_images(update.message.chat_id, images),
+            self.post_process(
+                update,
+                f"Correct! {item}" if result else f"No, that was {item}",
+                [["NEXT"], ["MENU"]],
+            ),
         )
+
+        if self.prefetch:
+            self.prepare_next(s)
         return self.PRACTICE
 
     @trace
-    def stats(self, update: Update, context: CallbackContext) -> int:
+    def prepare_next(self, s: dict) -> None:
+        """
+        Generate the next practice question of a session ahead of NEXT
+        and warm its audio unless Telegram already has it
+        """
+        s["next"] = s["pm"].generate()
+        url = s["next"].url_audio
+        if self.warmer is not None and self.file_ids.get(url) is None:
+            self.warmer.submit(url)
+
+    @trace
+    async def stats(self, update: Update, context: CallbackContext) -> int:
         """
         Display user`s practice statistics
         """
-        self.pre_process(update, "stats", False, False)
+        await self.pre_process(update, "stats", False, False)
 
         if update.message.text == "MENU":
-            return self.pre_action(update, context)
+            return await self.pre_action(update, context)
 
-        self.post_process(
+        await self.post_process(
             update,
             self.session_manager[update.message.chat_id]["user"].stats.prepare_stats(),
             [["MENU"]],
@@ -284,23 +630,25 @@ class Bot:
         return self.STATS
 
     @trace
-    def menu(self, update: Update, context: CallbackContext) -> int:
+    async def menu(self, update: Update, context: CallbackContext) -> int:
         """
         Display main menu
         """
-        self.pre_process(update, "menu", False, False)
+        await self.pre_process(update, "menu", False, False)
         # TODO: add 'THEORY'
-        self.post_process(update, "Menu:", [["PRACTICE"], ["STATS"], ["SETTINGS"]])
+        await self.post_process(
+            update, "Menu:", [["PRACTICE"], ["STATS"], ["SETTINGS"]]
+        )
         return self.PRE_ACTION
 
     @trace
-    def settings_menu(self, update: Update, context: CallbackContext) -> int:
+    async def settings_menu(self, update: Update, context: CallbackContext) -> int:
         """
         Display settings
         """
-        self.pre_process(update, "s_menu", False, True)
+        await self.pre_process(update, "s_menu", False, True)
         # TODO: add 'INTERVALS' and 'KEYS'
-        self.post_process(
+        await self.post_process(
             update,
             "Parctice Settings:",
             [["CHORDS"], ["MODES"], ["DISPLAY"], ["ABOUT"], ["MENU"]],
@@ -308,11 +656,11 @@ class Bot:
         return self.SETTINGS
 
     @trace
-    def settings_action(self, update: Update, context: CallbackContext) -> int:
+    async def settings_action(self, update: Update, context: CallbackContext) -> int:
         """
         Handle user`s selection in settings
         """
-        self.pre_process(update, "s_action", True, False)
+        await self.pre_process(update, "s_action", True, False)
         s = self.session_manager[update.message.chat_id]
 
         proxies = {
@@ -323,10 +671,10 @@ class Bot:
             "DISPLAY": self.settings_display,
         }
         if update.message.text in proxies.keys():
-            return proxies[update.message.text](update, context)
+            return await proxies[update.message.text](update, context)
 
         if update.message.text == "ABOUT":
-            self.post_process(
+            await self.post_process(
                 update,
                 "This telegram bot was built to help learn and practice in music theory.\nCoderOK @ 2023\nhttps://github.com/2CoderOK/",
                 [["BACK"]],
@@ -345,7 +693,12 @@ class Bot:
                         s["user"].settings.add_item(v[0], int(id))
                     else:
                         s["user"].settings.remove_item(v[0], int(id))
-                    return v[1](update, context)
+                    # a prepared question may use a removed item
+                    s["next"] = None
+                    self.user_manager.settings_changed(
+                        update.message.chat_id, s["user"], v[0]
+                    )
+                    return await v[1](update, context)
         elif "/show" in update.message.text or "/hide" in update.message.text:
             if "_0" in update.message.text:
                 action, id = update.message.text.split("_0")
@@ -353,17 +706,20 @@ class Bot:
                     s["user"].settings.add_item("display", int(id))
                 else:
                     s["user"].settings.remove_item("display", int(id))
-                return self.settings_display(update, context)
+                self.user_manager.settings_changed(
+                    update.message.chat_id, s["user"], "display"
+                )
+                return await self.settings_display(update, context)
 
         return self.PRE_ACTION
 
     @trace
-    def settings_chords(self, update: Update, context: CallbackContext) -> int:
+    async def settings_chords(self, update: Update, context: CallbackContext) -> int:
         """
         Handle Chords settings
         """
-        self.pre_process(update, "s_chords", True, False)
-        self.post_process(
+        await self.pre_process(update, "s_chords", True, False)
+        await self.post_process(
             update,
             self.session_manager[update.message.chat_id][
                 "user"
@@ -373,12 +729,12 @@ class Bot:
         return self.SETTINGS
 
     @trace
-    def settings_modes(self, update: Update, context: CallbackContext) -> int:
+    async def settings_modes(self, update: Update, context: CallbackContext) -> int:
         """
         Handle Modes settings
         """
-        self.pre_process(update, "s_modes", True, False)
-        self.post_process(
+        await self.pre_process(update, "s_modes", True, False)
+        await self.post_process(
             update,
             self.session_manager[update.message.chat_id][
                 "user"
@@ -388,12 +744,12 @@ class Bot:
         return self.SETTINGS
 
     @trace
-    def settings_display(self, update: Update, context: CallbackContext) -> int:
+    async def settings_display(self, update: Update, context: CallbackContext) -> int:
         """
         Handle Practice Display settings
         """
-        self.pre_process(update, "s_display", True, False)
-        self.post_process(
+        await self.pre_process(update, "s_display", True, False)
+        await self.post_process(
             update,
             self.session_manager[update.message.chat_id][
                 "user"
@@ -403,61 +759,200 @@ class Bot:
         return self.SETTINGS
 
     @trace
-    def cancel(self, update: Update, context: CallbackContext) -> int:
+    async def cancel(self, update: Update, context: CallbackContext) -> int:
         """
         Stop the chat
         """
-        self.pre_process(update, "cancel", False, False)
+        await self.pre_process(update, "cancel", False, False)
         return ConversationHandler.END
 
     @trace
-    def main(self) -> None:
+    def check_webhook(self, updater: Updater, webhook: dict) -> str:
+        """
+        Make sure a webhook can be started: the port is free, the certificate is valid
+        and Telegram accepts the webhook url with the certificate. Raises an exception
+        otherwise, returns the webhook url.
+        Updater.start_webhook would wait forever if its server thread failed.
+        """
+        listen = webhook.get("listen", "127.0.0.1")
+        port = webhook.get("port", 8443)
+        family = socket.AF_INET6 if ":" in listen else socket.AF_INET
+        with socket.socket(family) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((listen, port))
+
+        cert = None
+        if webhook.get("cert") and webhook.get("key"):
+            ssl.create_default_context(ssl.Purpose.CLIENT_AUTH).load_cert_chain(
+                webhook["cert"], webhook["key"]
+            )
+            cert = webhook["cert"]
+
+        url_path = "/" + webhook.get("url_path", "").lstrip("/")
+        # an IPv6 address is enclosed in brackets in a url
+        host = f"[{listen}]" if family == socket.AF_INET6 else listen
+        webhook_url = webhook.get("webhook_url") or f"https://{host}:{port}{url_path}"
+        # a self-signed certificate is uploaded like start_webhook does
+        with open(cert, "rb") if cert else nullcontext() as certificate:
+            if not updater.bot.set_webhook(
+                webhook_url,
+                certificate=certificate,
+                max_connections=webhook.get("max_connections", 40),
+            ):
+                raise RuntimeError(f"webhook {webhook_url} was not set")
+        return webhook_url
+
+    @trace
+    def start_updates(self, updater: Updater, settings: dict) -> None:
         """
-        The bot`s state machine setup
+        Start receiving updates with a webhook or long polling
         """
-        updater = Updater(self.settings["TOKEN"])
+        if settings.get("mode", "polling") == "webhook":
+            webhook = settings.get("webhook", {})
+            try:
+                webhook_url = self.check_webhook(updater, webhook)
+            except Exception as e:
+                if not settings.get("fallback_to_polling", True):
+                    raise
+                self.log.error(f"unable to start a webhook, fall back to polling: {e}")
+            else:
+                updater.start_webhook(
+                    listen=webhook.get("listen", "127.0.0.1"),
+                    port=webhook.get("port", 8443),
+                    url_path=webhook.get("url_path", ""),
+                    cert=webhook.get("cert") or None,
+                    key=webhook.get("key") or None,
+                    webhook_url=webhook_url,
+                    max_connections=webhook.get("max_connections", 40),
+                )
+                self.log.info("receiving updates with a webhook")
+                return
 
-        dispatcher = updater.dispatcher
+        updater.start_polling()
+        self.log.info("receiving updates with long polling")
 
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", self.start)],
-            states={
-                self.MENU: [
-                    MessageHandler(Filters.update.message, self.menu, run_async=True)
-                ],
-                self.PRACTICE_MENU: [
-                    MessageHandler(
-                        Filters.update.message, self.practice_menu, run_async=True
-                    )
-                ],
-                self.PRE_ACTION: [
-                    MessageHandler(
-                        Filters.update.message, self.pre_action, run_async=True
-                    )
-                ],
-                self.PRACTICE: [
-                    MessageHandler(Filters.update.message, self.practice, run_async=True)
-                ],
-                self.PRACTICE_RESPONSE: [
-                    MessageHandler(
-                        Filters.update.message, self.practice_response, run_async=True
-                    )
-                ],
-                self.STATS: [
-                    MessageHandler(Filters.update.message, self.stats, run_async=True)
-                ],
-                self.SETTINGS: [
-                    MessageHandler(
-                        Filters.update.message, self.settings_action, run_async=True
-                    )
-                ],
-            },
-            fallbacks=[CommandHandler("cancel", self.cancel)],
-            run_async=True,
+    @trace
+    def connection_pool_size(self, settings: dict) -> int:
+        """
+        The connection pool size of the updates settings, validated
+        against the number of threads making requests at the same time
+        """
+        required = required_pool_size(
+            settings.get("workers", 4),
+            settings.get("io_workers", 16),
+            self.settings.get("cleanup", {}).get("workers", 4),
         )
+        size = settings.get("con_pool_size", 0)
+        if size < required:
+            if size:
+                self.log.warning(
+                    f"con_pool_size {size} is below {required} threads making "
+                    f"requests (workers + 4 or io_workers + cleanup workers + 2), "
+                    f"using {required}"
+                )
+            size = required
+        return size
 
-        dispatcher.add_handler(conv_handler)
+    @trace
+    def start_bot(self) -> Updater:
+        """
+        The bot`s setup: start background workers and receiving updates
+        """
+        updates_settings = self.settings.get("updates", {})
+        request = PooledRequest(
+            self.connection_pool_size(updates_settings),
+            updates_settings.get("connect_timeout", 5.0),
+            updates_settings.get("read_timeout", 5.0),
+            updates_settings.get("keep_alive_idle", 120),
+            metrics=self.metrics,
+        )
+        bot = ExtBot(
+            self.settings["TOKEN"],
+            updates_settings.get("api_url") or None,
+            request=request,
+        )
+        updater = Updater(bot=bot, workers=updates_settings.get("workers", 4))
+
+        # handlers run on the event loop, the dispatcher thread only routes updates
+        updater.dispatcher.add_handler(
+            MessageHandler(Filters.update.message, self.on_update)
+        )
 
+        self.updater = updater
         self.bot = updater.bot
-        updater.start_polling()
+        self.cleaner.bot = self.bot
+
+        self.user_manager.start()
+        self.aio.start()
+        metrics_settings = self.settings.get("metrics", {})
+        if metrics_settings.get("enabled", False):
+            self.metrics_server = MetricsServer(
+                self.metrics,
+                metrics_settings.get("listen", "127.0.0.1"),
+                metrics_settings.get("port", 9100),
+            )
+            self.metrics_server.start()
+        if self.preload_limit:
+            self.preloader = threading.Thread(
+                target=self.preload_sessions, name="SessionPreloader", daemon=True
+            )
+            self.preloader.start()
+        self.start_updates(updater, updates_settings)
+        return updater
+
+    @trace
+    def preload_sessions(self) -> int:
+        """
+        Load sessions of recently active users in the background,
+        return the number of loaded sessions
+        """
+        self.active_users.load()
+        limit = min(self.preload_limit, self.session_manager.max_size)
+        loaded = 0
+        for chat_id in self.active_users.recent(self.preload_max_age, limit):
+            if self.stopping.is_set():
+                break
+            if chat_id not in self.session_manager:
+                self.session_manager[chat_id]
+                loaded += 1
+        self.log.info(f"preloaded {loaded} sessions")
+        return loaded
+
+    @trace
+    def stop_bot(self) -> None:
+        """
+        Stop receiving updates, finish started handlers
+        and write all pending data before exit
+        """
+        self.stopping.set()
+        if self.updater.running:
+            self.updater.stop()
+        if self.preloader is not None:
+            self.preloader.join()
+        self.aio.stop()
+        self.session_manager.clear()
+        self.user_manager.stop()
+        self.file_ids.save()
+        self.active_users.save()
+        # pending deletions may still be sent, but not past a long pause
+        self.outbound.stop(timeout=30.0)
+        self.cleaner.stop()
+        if self.warmer is not None:
+            self.warmer.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.logger.stop()
+
+    @trace
+    def main(self) -> None:
+        """
+        Run the bot until it is interrupted
+        """
+        updater = self.start_bot()
+
+        # dump trace stats on demand: kill -USR1 <pid>
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda *_: dump_trace_stats())
+
         updater.idle()
+        self.stop_bot()
@@ -0,0 +1,194 @@
+"""
+A practice catalog: every valid (practice type, scale, item, variant) combination
+with precomputed asset urls and labels, built once at startup
+"""
+import json
+
+from lib.logger import get_logger
+
+from lib.theory import (CHORD_INVERSIONS, CHORDS, MODES, MODES_LONG,
+                        MODES_TYPES, SCALES)
+
+# practice type -> (asset id, items, variants, items long names,
+#                   items setting name, variants setting name)
+PRACTICE_TYPES = {
+    "MODES": ("03", MODES, MODES_TYPES, MODES_LONG, "modes", "modes_types"),
+    "CHORDS": ("04", CHORDS, CHORD_INVERSIONS, CHORDS, "chords", "chord_inversions"),
+}
+
+
+class CatalogTable:
+    """
+    All (scale, item, variant) combinations of a practice type.
+    Urls are stored in flat tuples indexed by the combination.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        p_type: str,
+        item_id: str,
+        items: dict,
+        variants: dict,
+        long_names: dict,
+        items_setting: str,
+        variants_setting: str,
+    ):
+        self.p_type = p_type
+        self.item_id = item_id
+        self.items_setting = items_setting
+        self.variants_setting = variants_setting
+        self.scales = tuple(SCALES[i] for i in range(len(SCALES)))
+        self.items = tuple(str(items[i]) for i in range(len(items)))
+        self.variants = tuple(str(variants[i]) for i in range(len(variants)))
+        self.long_names = tuple(str(long_names[i]) for i in range(len(long_names)))
+        self.n_scales = len(self.scales)
+        self.n_items = len(self.items)
+        self.n_variants = len(self.variants)
+
+        audio, img, img2 = [], [], []
+        for sd in range(self.n_scales):
+            path = f"{item_id}/{sd + 1:02}"
+            for item in range(self.n_items):
+                file_id = f"{item_id}{sd:02}{item:02}"
+                img.append(f"{host}/img/{path}/{file_id}00.jpg")
+                img2.append(f"{host}/img/{path}/{file_id}01.png")
+                for variant in range(self.n_variants):
+                    audio.append(f"{host}/audio/{path}/{file_id}{variant:02}.mp3")
+        # indexed by index(scale, item, variant)
+        self.audio = tuple(audio)
+        # indexed by image_index(scale, item): piano keyboard and music notation
+        self.img = tuple(img)
+        self.img2 = tuple(img2)
+        # indexed by item * n_variants + variant: scales with an existing audio
+        all_scales = tuple(range(self.n_scales))
+        self.playable = [all_scales] * (self.n_items * self.n_variants)
+
+    def __len__(self) -> int:
+        return len(self.audio)
+
+    def index(self, scale: int, item: int, variant: int) -> int:
+        """
+        An index of a combination in the audio table
+        """
+        return (scale * self.n_items + item) * self.n_variants + variant
+
+    def image_index(self, scale: int, item: int) -> int:
+        """
+        An index of a (scale, item) in the images tables
+        """
+        return scale * self.n_items + item
+
+    def urls(self):
+        """
+        Iterate over all asset urls of the practice type
+        """
+        yield from self.audio
+        yield from self.img
+        yield from self.img2
+
+    def scales_for(self, item: int, variant: int) -> tuple:
+        """
+        Scales an (item, variant) combination has an audio in
+        """
+        return self.playable[item * self.n_variants + variant]
+
+    def exclude(self, missing: set) -> int:
+        """
+        Exclude combinations with a missing audio, return the number of excluded
+        """
+        excluded = 0
+        for item in range(self.n_items):
+            for variant in range(self.n_variants):
+                scales = tuple(
+                    sd
+                    for sd in range(self.n_scales)
+                    if self.audio[self.index(sd, item, variant)] not in missing
+                )
+                excluded += self.n_scales - len(scales)
+                self.playable[item * self.n_variants + variant] = scales
+        return excluded
+
+
+class PracticeCatalog:
+    """
+    Catalog tables of all practice types
+    """
+
+    def __init__(self, host: str):
+        self.log = get_logger()
+        self.host = host
+        self.tables = {
+            p_type: CatalogTable(host, p_type, *params)
+            for p_type, params in PRACTICE_TYPES.items()
+        }
+        # urls an assets check found missing on the host
+        self.missing = set()
+
+    def __len__(self) -> int:
+        return sum(len(t) for t in self.tables.values())
+
+    def urls(self):
+        """
+        Iterate over all asset urls in the catalog
+        """
+        for table in self.tables.values():
+            yield from table.urls()
+
+    def exists(self, url: str) -> bool:
+        """
+        Check an asset was not found missing on the host
+        """
+        return url not in self.missing
+
+    def apply_manifest(self, manifest: dict) -> bool:
+        """
+        Exclude missing assets of an assets manifest, return False if the manifest
+        was made for another host
+        """
+        if manifest.get("host") != self.host:
+            self.log.warning(
+                f"assets manifest is for {manifest.get('host')}, not {self.host}"
+            )
+            return False
+        self.missing = set(manifest.get("missing", []))
+        for p_type, table in self.tables.items():
+            excluded = table.exclude(self.missing)
+            if excluded:
+                self.log.warning(f"{p_type}: {excluded} audio files are missing")
+        return True
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Read an assets manifest written by tools/check_assets.py, None if there is none
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        get_logger().info(f"assets manifest not loaded: {e}")
+        return None
+
+
+def validate_theory() -> list:
+    """
+    Check the theory tables can be used to build a catalog and assets names,
+    return a list of found problems
+    """
+    problems = []
+    for p_type, (_, items, variants, long_names, *_) in PRACTICE_TYPES.items():
+        for name, data in (
+            ("items", items),
+            ("variants", variants),
+            ("long names", long_names),
+            ("scales", SCALES),
+        ):
+            if sorted(data) != list(range(len(data))):
+                problems.append(f"{p_type} {name} ids are not 0..{len(data) - 1}")
+            if len(data) > 100:
+                problems.append(f"{p_type} {name} do not fit two digits ids")
+        if len(long_names) != len(items):
+            problems.append(f"{p_type} long names do not match items")
+    return problems
+
@@ -0,0 +1,118 @@
+"""
+Background deletion of chat messages
+"""
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from telegram.error import BadRequest, InvalidToken, TelegramError
+
+from lib.logger import get_logger, trace
+from lib.outbound import BACKGROUND, OutboundScheduler
+
+# telegram can delete messages that are less than 48 hours old
+DELETE_AGE_LIMIT = 48 * 3600
+# maximum number of messages in a single deleteMessages request
+BULK_DELETE_LIMIT = 100
+
+
+class MessageCleaner:
+    """
+    Deletes chat messages off the reply path: in bulk (deleteMessages)
+    where the Bot API allows it, otherwise one by one in parallel.
+    Messages too old to be deleted are skipped. Deletions are sent through
+    the outbound scheduler behind the users` replies.
+    """
+
+    def __init__(
+        self,
+        bot=None,
+        workers: int = 4,
+        bulk: bool = True,
+        max_age: float = DELETE_AGE_LIMIT - 60,
+        outbound: OutboundScheduler = None,
+    ):
+        """
+        Keyword arguments:
+        bot -- a telegram bot
+        workers -- number of parallel deletions
+        bulk -- try deleteMessages first
+        max_age -- skip messages older than this (seconds)
+        outbound -- the bot`s outbound requests scheduler
+        """
+        self.log = get_logger()
+        self.bot = bot
+        self.bulk = bulk
+        self.max_age = max_age
+        self.outbound = outbound if outbound is not None else OutboundScheduler()
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="MessageCleaner"
+        )
+
+    @trace
+    def delete(self, chat_id: int, messages: dict) -> None:
+        """
+        Schedule deletion of messages {message_id: time it was tracked}
+        """
+        oldest = time() - self.max_age
+        ids = [i for i, ts in messages.items() if ts > oldest]
+        if len(ids) < len(messages):
+            self.log.debug(f"skip {len(messages) - len(ids)} old messages")
+        if not ids:
+            return
+
+        if self.bulk and len(ids) > 1:
+            for i in range(0, len(ids), BULK_DELETE_LIMIT):
+                self.executor.submit(
+                    self.delete_bulk, chat_id, ids[i : i + BULK_DELETE_LIMIT]
+                )
+        else:
+            for i in ids:
+                self.executor.submit(self.delete_one, chat_id, i)
+
+    def delete_one(self, chat_id: int, msg_id: int) -> bool:
+        """
+        Delete a single message, return False if the request failed
+        """
+        try:
+            # deletions are not sends, they count only to the bot`s rate limit
+            self.outbound.call(
+                None, BACKGROUND, self.bot.delete_message, chat_id, msg_id
+            )
+            return True
+        except BadRequest as e:
+            # already deleted or too old
+            self.log.debug(f"unable to delete {msg_id} in {chat_id}: {e}")
+        except TelegramError as e:
+            self.log.warning(f"unable to delete {msg_id} in {chat_id}: {e}")
+        return False
+
+    def delete_messages(self, chat_id: int, ids: list) -> bool:
+        """
+        deleteMessages request, python-telegram-bot 13 has no method for it
+        """
+        return self.bot._post(
+            "deleteMessages", {"chat_id": chat_id, "message_ids": ids}
+        )
+
+    def delete_bulk(self, chat_id: int, ids: list) -> None:
+        """
+        Delete messages with a single request,
+        fall back to single deletions if bulk is not supported
+        """
+        try:
+            self.outbound.call(None, BACKGROUND, self.delete_messages, chat_id, ids)
+            return
+        except InvalidToken as e:
+            # a Bot API server without deleteMessages responds with 404
+            self.log.warning(f"bulk delete is not supported: {e}")
+            self.bulk = False
+        except TelegramError as e:
+            self.log.warning(f"bulk delete failed, deleting one by one: {e}")
+        for i in ids:
+            self.delete_one(chat_id, i)
+
+    def stop(self) -> None:
+        """
+        Wait for scheduled deletions
+        """
+        self.executor.shutdown(wait=True)
@@ -1,7 +1,16 @@
 """This is a custom Logger for Telegram Bot application
 """
+import copy
+import json
 import logging
 import logging.handlers
+import queue
+import threading
+from bisect import bisect_left
+from functools import wraps
+from inspect import iscoroutinefunction
+from itertools import chain
+from time import monotonic, perf_counter
 
 LOGGER_NAME = "TGBotLogger"
 
@@ -13,8 +22,99 @@ def get_logger():
     return logging.getLogger(LOGGER_NAME)
 
 
+class JsonFormatter(logging.Formatter):
+    """A formatter of structured log records, one json object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "func": record.funcName,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """A queue handler that keeps an exception traceback apart from the message,
+    so it can be written as a separate field of a structured record
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """A filter that lets through at most rate records of a category (a call site,
+    and where an exception was raised) per interval, records below level are
+    not limited. The number of dropped records is logged with the next one.
+
+    Keyword arguments:
+    rate -- records of a category per interval
+    interval -- seconds
+    level -- the lowest limited level
+    """
+
+    def __init__(
+        self, rate: int = 20, interval: float = 60.0, level: int = logging.WARNING
+    ):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.level = level
+        # (path, line) -> [window start, records in the window, dropped]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        if record.exc_info and record.exc_info[2] is not None:
+            # different failures logged at one call site are limited separately
+            tb = record.exc_info[2]
+            while tb.tb_next is not None:
+                tb = tb.tb_next
+            key += (
+                record.exc_info[0],
+                tb.tb_frame.f_code.co_filename,
+                tb.tb_lineno,
+            )
+        now = monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < self.rate:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar messages dropped)"
+        return True
+
+
 class Logger:
-    """This is a custom Logger class"""
+    """This is a custom Logger class.
+    Records are passed through a queue to a background listener thread,
+    so file and console writes (and log rotation) stay off the callers` threads.
+    """
 
     def __init__(
         self,
@@ -26,6 +126,10 @@ class Logger:
         log_backup_count: int = 10,
         date_format: str = "",
         logger_name: str = LOGGER_NAME,
+        use_queue: bool = True,
+        json_lines: bool = False,
+        rate_limit: int = 0,
+        rate_interval: float = 60.0,
     ):
         """A custom Logger constructor.
 
@@ -36,6 +140,9 @@ class Logger:
         log_level -- log level
         max_log_size -- maxium size of a log file
         log_backup_count -- a log backup count
+        use_queue -- write records in a background thread
+        json_lines -- write the log file as json lines
+        rate_limit -- warnings and errors of a call site per rate_interval, 0 is off
         """ ""
         global log
         log = logging.getLogger(logger_name)
@@ -47,40 +154,203 @@ class Logger:
                 datetime.datetime.now(), date_format
             )
             filename = filename.replace("%DATETIME%", formatted_date)
-        handler1 = logging.FileHandler(filename, "w", "utf-8")
-        handler1 = logging.handlers.RotatingFileHandler(
-            filename, maxBytes=max_log_size, backupCount=log_backup_count
-        )
         formatter = logging.Formatter(
             "%(levelname)s %(asctime)s [%(funcName)s] %(message)s"
         )
-        handler1.setFormatter(formatter)
-        handler1.setLevel(log_level)
-        handler2 = logging.StreamHandler()
-        handler2.setFormatter(formatter)
-        handler2.setLevel(log_level)
+        handlers = []
         if console:
-            log.addHandler(handler2)
+            handler2 = logging.StreamHandler()
+            handler2.setFormatter(formatter)
+            handler2.setLevel(log_level)
+            handlers.append(handler2)
         if file:
-            log.addHandler(handler1)
+            handler1 = logging.handlers.RotatingFileHandler(
+                filename, maxBytes=max_log_size, backupCount=log_backup_count
+            )
+            handler1.setFormatter(JsonFormatter() if json_lines else formatter)
+            handler1.setLevel(log_level)
+            handlers.append(handler1)
+
+        self.listener = None
+        if use_queue and handlers:
+            records = queue.SimpleQueue()
+            self.listener = logging.handlers.QueueListener(
+                records, *handlers, respect_handler_level=True
+            )
+            self.listener.start()
+            handlers = [RecordQueueHandler(records)]
+        for handler in handlers:
+            if rate_limit:
+                handler.addFilter(RateLimitFilter(rate_limit, rate_interval))
+            log.addHandler(handler)
+
+    def stop(self) -> None:
+        """Write all queued records and stop the listener thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+# upper bounds (in seconds) of the latency histogram buckets: 1us .. ~1000s
+TRACE_BUCKETS = tuple(1e-6 * 2 ** (i / 2) for i in range(60))
+
+
+class TraceConfig:
+    """
+    Runtime tracing configuration shared by all traced functions
+    """
+
+    enabled: bool = False
+    sample_rate: int = 1
+    log_args: bool = False
+
+
+class TraceStats:
+    """
+    Call count and latency histogram of a traced function
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.sampled = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(TRACE_BUCKETS) + 1)
+        self.lock = threading.Lock()
+
+    def count(self) -> int:
+        """
+        Count a call, return its number
+        """
+        with self.lock:
+            self.calls += 1
+            return self.calls
+
+    def add(self, elapsed: float) -> None:
+        """
+        Record a sampled call latency
+        """
+        i = bisect_left(TRACE_BUCKETS, elapsed)
+        with self.lock:
+            self.sampled += 1
+            self.total += elapsed
+            self.buckets[i] += 1
+
+    def percentile(self, p: float) -> float:
+        """
+        Estimate a latency percentile (upper bound of the matching bucket)
+        """
+        rank = self.sampled * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return TRACE_BUCKETS[min(i, len(TRACE_BUCKETS) - 1)]
+        return 0.0
+
+    def as_dict(self) -> dict:
+        """
+        Summary of the collected statistics
+        """
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "sampled": self.sampled,
+                "avg": self.total / self.sampled if self.sampled else 0.0,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+            }
+
+
+trace_stats = {}
+
+
+def configure_trace(
+    enabled: bool = True, sample_rate: int = 1, log_args: bool = False
+) -> None:
+    """Enable or disable tracing of all traced functions
+
+    Keyword arguments:
+    enabled -- collect call counts and latencies
+    sample_rate -- time and log only 1 in N calls
+    log_args -- log function arguments of sampled calls (DEBUG level only)
+    """
+    TraceConfig.sample_rate = max(1, int(sample_rate))
+    TraceConfig.log_args = log_args
+    TraceConfig.enabled = enabled
+
+
+def get_trace_stats() -> dict:
+    """A function to get a summary of all traced functions that were called"""
+    return {name: st.as_dict() for name, st in trace_stats.items() if st.calls > 0}
+
+
+def dump_trace_stats() -> str:
+    """Log and return a table of call counts and latencies (in ms)"""
+    text = "{:<40} {:>10} {:>10} {:>10} {:>10} {:>10}\n".format(
+        "function", "calls", "sampled", "p50", "p95", "p99"
+    )
+    for name, st in sorted(get_trace_stats().items()):
+        text += "{:<40} {:>10} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}\n".format(
+            name,
+            st["calls"],
+            st["sampled"],
+            st["p50"] * 1000,
+            st["p95"] * 1000,
+            st["p99"] * 1000,
+        )
+    get_logger().info(f"trace stats:\n{text}")
+    return text
 
 
 def trace(fn):
-    """A built-in function`s logging
+    """A built-in function`s tracing: call counts, latencies and arguments logging.
+    When tracing is disabled a call costs a single flag check.
 
     Keyword arguments:
     fn -- a function to be traced
     """
-    # comment next line to enable tracing
-    # return fn
+    stats = trace_stats.setdefault(fn.__qualname__, TraceStats(fn.__qualname__))
+    logger = get_logger()
 
-    from itertools import chain
+    if iscoroutinefunction(fn):
 
-    def trace(*v, **k):
-        global log
+        @wraps(fn)
+        async def trace(*v, **k):
+            if not TraceConfig.enabled:
+                return await fn(*v, **k)
+            calls = stats.count()
+            if calls % TraceConfig.sample_rate:
+                return await fn(*v, **k)
+            if TraceConfig.log_args and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "%s(%s)"
+                    % (fn.__name__, ", ".join(map(repr, chain(v, k.values()))))
+                )
+            start = perf_counter()
+            try:
+                return await fn(*v, **k)
+            finally:
+                stats.add(perf_counter() - start)
 
-        name = fn.__name__
-        log.debug("%s(%s)" % (name, ", ".join(map(repr, chain(v, k.values())))))
-        return fn(*v, **k)
+        return trace
+
+    @wraps(fn)
+    def trace(*v, **k):
+        if not TraceConfig.enabled:
+            return fn(*v, **k)
+        calls = stats.count()
+        if calls % TraceConfig.sample_rate:
+            return fn(*v, **k)
+        if TraceConfig.log_args and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s(%s)" % (fn.__name__, ", ".join(map(repr, chain(v, k.values()))))
+            )
+        start = perf_counter()
+        try:
+            return fn(*v, **k)
+        finally:
+            stats.add(perf_counter() - start)
 
     return trace
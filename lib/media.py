@@ -0,0 +1,223 @@
+"""
+A persistent cache of Telegram file ids of the practice media
+and warming of the assets that are about to be sent
+"""
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from lib.logger import get_logger, trace
+from lib.storage import atomic_write
+
+
+class FileIdCache:
+    """
+    Maps an asset url to the Telegram file_id returned by the first successful send,
+    so later sends reuse the uploaded file instead of downloading the url again.
+    The whole cache is dropped when the assets version changes.
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/file_ids.json",
+        version: str = "",
+        save_delay: float = 10.0,
+    ):
+        """
+        Keyword arguments:
+        path -- a json file with the cache
+        version -- assets version, change it when assets on HOST are updated
+        save_delay -- seconds to collect new file ids before saving the cache
+        """
+        self.log = get_logger()
+        self.path = path
+        self.version = version
+        self.save_delay = save_delay
+        self.files = {}
+        # asset url -> its etag on the host when its file id was cached
+        self.etags = {}
+        self.lock = threading.Lock()
+        self.timer = None
+        self.load()
+
+    def load(self) -> None:
+        """
+        Load the cache from a json file
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.log.warning(f"file ids cache not loaded: {e}")
+            return
+        if data.get("version") != self.version:
+            self.log.warning("assets version changed, file ids cache dropped")
+            return
+        self.files = data.get("files", {})
+        self.etags = data.get("etags", {})
+
+    def get(self, url: str) -> str:
+        """
+        Get a file id of an url, None if not cached
+        """
+        return self.files.get(url)
+
+    @trace
+    def set(self, url: str, file_id: str) -> None:
+        """
+        Store a file id of an url
+        """
+        if self.files.get(url) == file_id:
+            return
+        with self.lock:
+            self.files[url] = file_id
+            self.schedule_save()
+
+    @trace
+    def invalidate(self, url: str) -> None:
+        """
+        Forget a file id of an url (e.g. the asset has changed)
+        """
+        with self.lock:
+            if self.files.pop(url, None) is not None:
+                self.schedule_save()
+
+    @trace
+    def sync_etags(self, etags: dict) -> int:
+        """
+        Forget file ids of assets whose etag has changed on the host,
+        return the number of forgotten file ids
+        """
+        changed = 0
+        with self.lock:
+            for url, etag in etags.items():
+                old = self.etags.get(url)
+                if old == etag:
+                    continue
+                if old is not None and self.files.pop(url, None) is not None:
+                    changed += 1
+                self.etags[url] = etag
+                self.schedule_save()
+        if changed:
+            self.log.info(f"{changed} assets changed, their file ids dropped")
+        return changed
+
+    def schedule_save(self) -> None:
+        """
+        Save the cache later, changes made meanwhile are saved together
+        """
+        if self.timer is None:
+            self.timer = threading.Timer(self.save_delay, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    @trace
+    def save(self) -> None:
+        """
+        Save the cache to a json file
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            text = json.dumps(
+                {"version": self.version, "files": self.files, "etags": self.etags}
+            )
+        try:
+            atomic_write(self.path, text)
+        except OSError as e:
+            self.log.warning(f"unable to save file ids cache: {e}")
+
+
+class MediaWarmer:
+    """
+    Fetches an asset ahead of its first send, so the assets host (or its CDN)
+    serves it hot when Telegram downloads the url.
+    Recently warmed urls are not fetched again. Fetches run on their own
+    small pool, so a slow host does not hold the threads of Telegram requests.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 5.0,
+        max_size: int = 10000,
+        ttl: float = 600.0,
+        workers: int = 2,
+        max_queued: int = 100,
+    ):
+        """
+        Keyword arguments:
+        timeout -- seconds to wait for an asset
+        max_size -- maximum number of remembered warm urls
+        ttl -- seconds an url is considered warm
+        workers -- number of fetches running at the same time
+        max_queued -- fetches waiting for a worker, later urls are not warmed
+        """
+        self.log = get_logger()
+        self.timeout = timeout
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_queued = max_queued
+        self.warmed = OrderedDict()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="MediaWarmer")
+
+    def is_warm(self, url: str) -> bool:
+        """
+        Check an url was warmed recently, remember it as warm otherwise
+        """
+        now = time()
+        with self.lock:
+            ts = self.warmed.get(url)
+            if ts is not None and now - ts < self.ttl:
+                return True
+            self.warmed[url] = now
+            self.warmed.move_to_end(url)
+            while len(self.warmed) > self.max_size:
+                self.warmed.popitem(last=False)
+        return False
+
+    def submit(self, url: str) -> bool:
+        """
+        Warm an url in the background, return False if too many are queued
+        """
+        with self.lock:
+            if self.queued >= self.max_queued:
+                return False
+            self.queued += 1
+        self.executor.submit(self.run, url)
+        return True
+
+    def run(self, url: str) -> None:
+        try:
+            self.warm(url)
+        finally:
+            with self.lock:
+                self.queued -= 1
+
+    def stop(self) -> None:
+        """
+        Drop queued fetches, the running ones end within the timeout
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @trace
+    def warm(self, url: str) -> bool:
+        """
+        Fetch an url unless it is warm already, return True if it was fetched
+        """
+        if self.is_warm(url):
+            return False
+        try:
+            with urlopen(url, timeout=self.timeout) as response:
+                while response.read(65536):
+                    pass
+            return True
+        except (URLError, OSError, ValueError) as e:
+            self.log.debug(f"unable to warm {url}: {e}")
+            return False
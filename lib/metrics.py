@@ -0,0 +1,250 @@
+"""
+Runtime metrics of the bot, served over HTTP in the Prometheus text format
+"""
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from lib.logger import get_logger
+
+# upper bounds (in seconds) of the latency histograms buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """
+    A monotonically increasing value per labels
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """
+    Observed values per labels, counted in cumulative buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: tuple = (), buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels -> [counts per bucket (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        """
+        A context manager observing the duration of its block
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(c), s) for labels, (c, s) in self.values.items()]
+        for labels, counts, total in values:
+            seen = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                seen += n
+                yield (
+                    f"{self.name}_bucket",
+                    format_labels(self.labels + ("le",), labels + (bound,)),
+                    seen,
+                )
+            label_text = format_labels(self.labels, labels)
+            yield f"{self.name}_sum", label_text, total
+            yield f"{self.name}_count", label_text, seen
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+
+class Callback:
+    """
+    A value read from the application when metrics are collected
+    """
+
+    def __init__(self, name: str, help: str, fn, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.fn()
+
+
+class Registry:
+    """
+    All metrics of the bot
+    """
+
+    def __init__(self, prefix: str = "tgbot_"):
+        self.log = get_logger()
+        self.prefix = prefix
+        # name -> metric, in the order of registration
+        self.metrics = {}
+
+    def add(self, metric):
+        """
+        Register a metric, return an already registered one of the same name
+        """
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = ()) -> Histogram:
+        return self.add(Histogram(self.prefix + name, help, labels))
+
+    def gauge_fn(self, name: str, help: str, fn) -> Callback:
+        return self.add(Callback(self.prefix + name, help, fn))
+
+    def counter_fn(self, name: str, help: str, fn) -> Callback:
+        return self.add(Callback(self.prefix + name, help, fn, "counter"))
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{labels} {value}")
+            except Exception as e:
+                self.log.warning(f"unable to collect {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+class ApiMetrics:
+    """
+    Counts, latencies and errors of Telegram Bot API calls by method
+    """
+
+    def __init__(self, registry: Registry):
+        self.calls = registry.counter(
+            "api_calls_total", "Telegram API calls", ("method",)
+        )
+        self.errors = registry.counter(
+            "api_errors_total", "Failed Telegram API calls", ("method", "error")
+        )
+        self.latency = registry.histogram(
+            "api_seconds", "Telegram API call latency", ("method",)
+        )
+
+    @contextmanager
+    def measure(self, method: str):
+        """
+        Count a call made in the block
+        """
+        self.calls.inc(method)
+        start = perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            self.latency.observe(perf_counter() - start, method)
+
+
+class MetricsServer:
+    """
+    Serves metrics of a registry at /metrics
+    """
+
+    def __init__(
+        self, registry: Registry, listen: str = "127.0.0.1", port: int = 9100
+    ):
+        self.log = get_logger()
+        self.registry = registry
+        self.server = ThreadingHTTPServer((listen, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> None:
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="MetricsServer", daemon=True
+        )
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        self.log.info(f"metrics are served at http://{host}:{port}/metrics")
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,389 @@
+"""
+Rate limited sending of the bot`s Telegram API requests
+"""
+import asyncio
+import threading
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+
+from telegram.error import RetryAfter, TelegramError
+
+from lib.logger import get_logger
+from lib.metrics import ApiMetrics, Registry
+
+# requests priorities, a lower value goes first
+REPLY = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {REPLY: "reply", BACKGROUND: "background"}
+# seconds a blocked thread waits before checking if the scheduler is stopped
+STOP_POLL = 1.0
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average and up to burst at once,
+    a zero rate is unlimited. Not thread safe.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = monotonic()
+
+    def delay(self, now: float) -> float:
+        """
+        Seconds until a token is available, 0 if it is available now
+        """
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        return self.rate <= 0 or (self.delay(now) == 0 and self.tokens >= self.burst)
+
+
+class SchedulerStopped(TelegramError):
+    """
+    The request was not sent because the scheduler was stopped
+    """
+
+
+class Waiter:
+    """
+    A request waiting for the rate limits
+    """
+
+    __slots__ = ("priority", "arrival", "chat_id", "wake", "done")
+
+    def __init__(self, priority: int, arrival: int, chat_id: int, wake):
+        self.priority = priority
+        self.arrival = arrival
+        self.chat_id = chat_id
+        # called with None when the request may be sent, with an error if not
+        self.wake = wake
+        self.done = False
+
+
+class OutboundScheduler:
+    """
+    Sends Telegram API requests within global and per-chat rate limits.
+    Waiting requests are sent in the order of their priority and arrival,
+    a request of a chat that is out of tokens is parked until the chat
+    has a token again and does not hold back other chats. A request rate
+    limited by Telegram pauses all sending for retry_after and is retried.
+
+    A single dispatcher grants tokens: right away when a request arrives,
+    otherwise from a background thread sleeping until the next token.
+    Only the granted request is woken up. Coroutines wait on the event loop
+    (call_async), background threads wait on their own thread (call).
+    """
+
+    def __init__(
+        self,
+        rate: float = 30.0,
+        burst: int = 30,
+        chat_rate: float = 1.0,
+        chat_burst: int = 10,
+        max_retries: int = 3,
+        max_chats: int = 10000,
+        metrics: Registry = None,
+    ):
+        """
+        Keyword arguments:
+        rate -- requests per second of the bot, 0 is unlimited
+        burst -- requests the bot may send at once
+        chat_rate -- requests per second to a chat, 0 is unlimited
+        chat_burst -- requests to a chat that may be sent at once
+        max_retries -- number of retries of a request rate limited by Telegram
+        max_chats -- number of chats buckets kept before idle ones are dropped
+        metrics -- a registry for requests and waiting metrics
+        """
+        self.log = get_logger()
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        # chat_id -> its TokenBucket
+        self.chats = {}
+        # all sending is paused until then after a rate limit error
+        self.paused_until = 0.0
+        # heap of (priority, arrival, Waiter) of requests that may be sent
+        # as soon as there is a token of the bot
+        self.ready = []
+        # heap of (time, priority, arrival, Waiter) of requests of chats
+        # that are out of tokens until then
+        self.parked = []
+        self.waiting = 0
+        self.arrivals = count()
+        # waiting requests fail after this time once the scheduler is stopped
+        self.stop_at = None
+        self.lock = threading.Lock()
+        self.timer = threading.Condition(self.lock)
+        self.dispatcher = None
+
+        metrics = metrics if metrics is not None else Registry()
+        self.api_metrics = ApiMetrics(metrics)
+        self.wait_latency = metrics.histogram(
+            "outbound_wait_seconds",
+            "Time a request waited for the rate limits by priority",
+            ("priority",),
+        )
+        self.rate_limited = metrics.counter(
+            "outbound_rate_limited_total", "Requests rate limited by Telegram"
+        )
+        metrics.gauge_fn(
+            "outbound_waiting",
+            "Requests waiting for the rate limits",
+            lambda: self.waiting,
+        )
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                now = monotonic()
+                self.chats = {
+                    k: v for k, v in self.chats.items() if not v.full(now)
+                }
+            bucket = self.chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst
+            )
+        return bucket
+
+    def chat_delay(self, chat_id: int, now: float) -> float:
+        if chat_id is None or self.chat_rate <= 0:
+            return 0.0
+        return self.chat_bucket(chat_id).delay(now)
+
+    def finish(self, waiter: Waiter, error: Exception = None) -> None:
+        """
+        Remove a request from the waiting ones and wake it up
+        """
+        waiter.done = True
+        self.waiting -= 1
+        waiter.wake(error)
+
+    def fail_all(self, error: Exception) -> None:
+        for entry in self.ready:
+            if not entry[-1].done:
+                self.finish(entry[-1], error)
+        for entry in self.parked:
+            if not entry[-1].done:
+                self.finish(entry[-1], error)
+        self.ready = []
+        self.parked = []
+
+    def dispatch(self, now: float):
+        """
+        Grant tokens to the waiting requests that may be sent now,
+        return the time to dispatch again, None if nothing is waiting
+        """
+        if self.stop_at is not None and now >= self.stop_at:
+            self.fail_all(SchedulerStopped("outbound scheduler is stopped"))
+            return None
+        while self.parked and self.parked[0][0] <= now:
+            _, priority, arrival, waiter = heappop(self.parked)
+            if not waiter.done:
+                heappush(self.ready, (priority, arrival, waiter))
+        next_time = None
+        while self.ready:
+            waiter = self.ready[0][2]
+            if waiter.done:
+                # cancelled while waiting
+                heappop(self.ready)
+                continue
+            wait = max(self.paused_until - now, self.bucket.delay(now))
+            if wait > 0:
+                next_time = now + wait
+                break
+            priority, arrival, _ = heappop(self.ready)
+            chat_wait = self.chat_delay(waiter.chat_id, now)
+            if chat_wait > 0:
+                heappush(self.parked, (now + chat_wait, priority, arrival, waiter))
+                continue
+            self.bucket.take()
+            if waiter.chat_id is not None and self.chat_rate > 0:
+                self.chat_bucket(waiter.chat_id).take()
+            self.finish(waiter)
+        if self.parked and (next_time is None or self.parked[0][0] < next_time):
+            next_time = self.parked[0][0]
+        if self.stop_at is not None and next_time is not None:
+            next_time = min(next_time, self.stop_at)
+        return next_time
+
+    def run(self) -> None:
+        """
+        The dispatcher thread, grants tokens to requests that could not get
+        one when they arrived
+        """
+        with self.lock:
+            while True:
+                next_time = self.dispatch(monotonic())
+                if next_time is None and self.stop_at is not None:
+                    break
+                self.timer.wait(
+                    None if next_time is None else max(0.0, next_time - monotonic())
+                )
+            self.dispatcher = None
+
+    def enter(self, chat_id: int, priority: int, wake) -> Waiter:
+        """
+        Add a waiting request, wake is called with None when it may be sent
+        or with an error if it will not be sent. It may be called right away.
+        """
+        with self.lock:
+            waiter = Waiter(priority, next(self.arrivals), chat_id, wake)
+            if self.stop_at is not None and monotonic() >= self.stop_at:
+                waiter.done = True
+                wake(SchedulerStopped("outbound scheduler is stopped"))
+                return waiter
+            self.waiting += 1
+            heappush(self.ready, (priority, waiter.arrival, waiter))
+            self.dispatch(monotonic())
+            if not waiter.done:
+                if self.dispatcher is None:
+                    self.dispatcher = threading.Thread(
+                        target=self.run, name="OutboundScheduler", daemon=True
+                    )
+                    self.dispatcher.start()
+                else:
+                    self.timer.notify()
+        return waiter
+
+    def cancel(self, waiter: Waiter) -> None:
+        """
+        Forget a waiting request that will not be sent
+        """
+        with self.lock:
+            if not waiter.done:
+                waiter.done = True
+                self.waiting -= 1
+
+    def acquire(self, chat_id: int = None, priority: int = BACKGROUND) -> float:
+        """
+        Wait on the current thread until a request can be sent,
+        return the waited time
+        """
+        start = monotonic()
+        woken = threading.Event()
+        result = []
+
+        def wake(error):
+            result.append(error)
+            woken.set()
+
+        waiter = self.enter(chat_id, priority, wake)
+        # a bounded wait, the waiter fails by itself once the scheduler is
+        # stopped even if the dispatcher does not wake it
+        while not woken.wait(STOP_POLL):
+            if self.stop_at is not None and monotonic() >= self.stop_at:
+                self.cancel(waiter)
+                if not woken.is_set():
+                    raise SchedulerStopped("outbound scheduler is stopped")
+        if result[0] is not None:
+            raise result[0]
+        return monotonic() - start
+
+    async def acquire_async(self, chat_id: int = None, priority: int = REPLY) -> float:
+        """
+        Wait on the event loop until a request can be sent,
+        return the waited time
+        """
+        start = monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def settle(error):
+            if future.done():
+                return
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+        def wake(error):
+            try:
+                loop.call_soon_threadsafe(settle, error)
+            except RuntimeError:
+                # the event loop is closed
+                pass
+
+        waiter = self.enter(chat_id, priority, wake)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.cancel(waiter)
+            raise
+        return monotonic() - start
+
+    def pause(self, seconds: float) -> None:
+        """
+        Pause all sending, e.g. for retry_after of a rate limit error
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+    def stop(self, timeout: float = 0.0) -> None:
+        """
+        Let waiting requests be sent for up to timeout seconds,
+        then fail them and all new requests with SchedulerStopped
+        """
+        with self.lock:
+            self.stop_at = monotonic() + timeout
+            if self.dispatcher is None:
+                self.dispatch(monotonic())
+            else:
+                self.timer.notify()
+
+    def retry(self, e: RetryAfter, attempt: int, method: str) -> bool:
+        """
+        Pause sending for a rate limited request, return False if out of retries
+        """
+        self.rate_limited.inc()
+        if attempt == self.max_retries:
+            return False
+        self.log.warning(f"{method} rate limited, retry after {e.retry_after}s")
+        self.pause(e.retry_after)
+        return True
+
+    def call(self, chat_id: int, priority: int, fn, *args, **kwargs):
+        """
+        Make a blocking API request within the rate limits on the current thread.
+        chat_id is the chat a message is sent to, None for requests
+        that are not sends (e.g. deletions) and count only to the bot`s limit.
+        """
+        method = getattr(fn, "__name__", "unknown")
+        for attempt in range(self.max_retries + 1):
+            waited = self.acquire(chat_id, priority)
+            self.wait_latency.observe(waited, PRIORITY_NAMES.get(priority, priority))
+            try:
+                with self.api_metrics.measure(method):
+                    return fn(*args, **kwargs)
+            except RetryAfter as e:
+                if not self.retry(e, attempt, method):
+                    raise
+
+    async def call_async(self, run, chat_id: int, priority: int, fn, *args, **kwargs):
+        """
+        Await an API request within the rate limits: wait on the event loop,
+        then run the blocking request with run (e.g. AsyncRunner.call)
+        """
+        method = getattr(fn, "__name__", "unknown")
+        for attempt in range(self.max_retries + 1):
+            waited = await self.acquire_async(chat_id, priority)
+            self.wait_latency.observe(waited, PRIORITY_NAMES.get(priority, priority))
+            try:
+                with self.api_metrics.measure(method):
+                    return await run(fn, *args, **kwargs)
+            except RetryAfter as e:
+                if not self.retry(e, attempt, method):
+                    raise
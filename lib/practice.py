@@ -3,11 +3,18 @@ A practice module that contains all practice related information and functionali
 """
 from dataclasses import dataclass
 from enum import Enum
-from random import choice, randint, sample
+from functools import lru_cache
+from random import choice, randrange, sample
 
+from lib.catalog import PracticeCatalog
 from lib.logger import get_logger, trace
-from lib.theory import (CHORD_INVERSIONS, CHORDS, MODES, MODES_LONG,
-                        MODES_TYPES, SCALES)
+from lib.sampling import AdaptiveSelector
+from lib.theory import CHORD_INVERSIONS, CHORDS, MODES, MODES_TYPES
+
+# attempts to pick a combination that has an audio on the assets host
+MAX_PICKS = 10
+# display settings: show or hide an image of a practice answer
+DISPLAY_OPTIONS = {0: "Musical Notation", 1: "Piano Keyboard"}
 
 
 @dataclass
@@ -32,64 +39,131 @@ class PracticeItem:
     question_text: str
 
 
+# practice settings names -> items a setting selects from
+SETTINGS_TABLES = {
+    "chords": CHORDS,
+    "chord_inversions": CHORD_INVERSIONS,
+    "modes": MODES,
+    "modes_types": MODES_TYPES,
+    "display": DISPLAY_OPTIONS,
+}
+
+
+def to_mask(values) -> int:
+    """
+    A bitmask of selected item ids
+    """
+    mask = 0
+    for v in values:
+        mask |= 1 << int(v)
+    return mask
+
+
+@lru_cache(maxsize=1024)
+def from_mask(mask: int, size: int) -> tuple:
+    """
+    Selected item ids below size of a bitmask, in ascending order
+    """
+    return tuple(i for i in range(size) if mask >> i & 1)
+
+
+@lru_cache(maxsize=256)
+def add_remove_text(name: str, desc: str, id: int, mask: int) -> str:
+    """
+    A text for a user to see which practice elements can be added or removed
+    """
+    text = f"Add or remove {desc} for your practice:\n\n"
+    for d, value in SETTINGS_TABLES[name].items():
+        text += "{}{}".format(value, " " * (30 - len(value)))
+        if mask >> d & 1:
+            text += f"/remove_{id}{d}\n"
+        else:
+            text += f"/add_{id}{d}\n"
+    return text
+
+
+@lru_cache(maxsize=256)
+def display_text(mask: int) -> str:
+    """
+    A text for display settings (show/hide piano keyboard or music notation)
+    """
+    text = "Show or hide items for your practice:\n\n"
+    for k, v in DISPLAY_OPTIONS.items():
+        text += "{}{}".format(v, " " * (30 - len(v)))
+        if mask >> k & 1:
+            text += f"/hide_0{k}\n"
+        else:
+            text += f"/show_0{k}\n"
+    return text
+
+
 class PracticeSettings:
     """
     Practice Settings class that holds information
-    about items that should be used during a practice
+    about items that should be used during a practice.
+    Selected items are kept as bitmasks over the theory tables,
+    settings texts are shared by all users with the same selection.
     """
 
     def __init__(self):
         self.log = get_logger()
-        self.data = {
-            "chords": [0, 1, 3],
-            "chord_inversions": [0, 3],
-            "modes": [0, 1, 2, 3, 4, 5, 6],
-            "modes_types": [0],
-            "display": [0, 1],
-            "HOST": "https://",
+        self.masks = {
+            "chords": to_mask([0, 1, 3]),
+            "chord_inversions": to_mask([0, 3]),
+            "modes": to_mask([0, 1, 2, 3, 4, 5, 6]),
+            "modes_types": to_mask([0]),
+            "display": to_mask([0, 1]),
         }
 
-    @trace
-    def add_item(self, item_name: str, item_value: int) -> None:
+    def get(self, item_name: str) -> tuple:
+        """
+        Selected practice elements, in ascending order
+        """
+        return from_mask(self.masks[item_name], len(SETTINGS_TABLES[item_name]))
+
+    def set(self, item_name: str, values: list) -> None:
         """
-        Add a new practice element (e.g. chord, mode and etc) to the practice
+        Select practice elements, e.g. loaded from a profile
         """
-        if item_value not in self.data[item_name]:
-            self.data[item_name].append(item_value)
+        size = len(SETTINGS_TABLES[item_name])
+        self.masks[item_name] = to_mask(v for v in values if 0 <= int(v) < size)
+
+    def selected(self, item_name: str, item_value: int) -> bool:
+        """
+        Check a practice element is selected
+        """
+        return bool(self.masks[item_name] >> item_value & 1)
 
     @trace
-    def remove_item(self, item_name: str, item_value: int) -> None:
+    def add_item(self, item_name: str, item_value: int) -> None:
         """
-        Remove an existing practice element from the practice
+        Add a new practice element (e.g. chord, mode and etc) to the practice,
+        an unknown element is ignored
         """
-        if item_value in self.data[item_name]:
-            self.data[item_name].remove(item_value)
-        if len(self.data[item_name]) == 0:
-            self.data[item_name].append(0)
+        if 0 <= item_value < len(SETTINGS_TABLES[item_name]):
+            self.masks[item_name] |= 1 << item_value
 
     @trace
-    def print_add_remove(self, name: str, desc: str, data: dict, id: int) -> str:
+    def remove_item(self, item_name: str, item_value: int) -> None:
         """
-        Prepare a text for a user to see which practice elements can be added or removed
+        Remove an existing practice element from the practice,
+        an unknown element is ignored
         """
-        text = f"Add or remove {desc} for your practice:\n\n"
-        for d in data.keys():
-            text += "{}{}".format(data[d], " " * (30 - len(data[d])))
-            if d in self.data[name]:
-                text += f"/remove_{id}{d}\n"
-            else:
-                text += f"/add_{id}{d}\n"
-        return text
+        if not 0 <= item_value < len(SETTINGS_TABLES[item_name]):
+            return
+        self.masks[item_name] &= ~(1 << item_value)
+        if self.masks[item_name] == 0:
+            self.masks[item_name] = 1
 
     @trace
     def print_chord_settings(self) -> str:
         """
         Prepare a text for chords in practice settings
         """
-        text = self.print_add_remove("chords", "chords", CHORDS, 0)
+        text = add_remove_text("chords", "chords", 0, self.masks["chords"])
         text += "\n"
-        text += self.print_add_remove(
-            "chord_inversions", "chord inversions", CHORD_INVERSIONS, 1
+        text += add_remove_text(
+            "chord_inversions", "chord inversions", 1, self.masks["chord_inversions"]
         )
         return text
 
@@ -98,9 +172,11 @@ class PracticeSettings:
         """
         Prepare a text for modes in practice settings
         """
-        text = self.print_add_remove("modes", "modes", MODES, 2)
+        text = add_remove_text("modes", "modes", 2, self.masks["modes"])
         text += "\n"
-        text += self.print_add_remove("modes_types", "modes directions", MODES_TYPES, 3)
+        text += add_remove_text(
+            "modes_types", "modes directions", 3, self.masks["modes_types"]
+        )
         return text
 
     @trace
@@ -108,104 +184,82 @@ class PracticeSettings:
         """
         Prepare a text for display settings (show/hide piano keyboard or music notation)
         """
-        text = "Show or hide items for your practice:\n\n"
-        options = {0: "Musical Notation", 1: "Piano Keyboard"}
-
-        for k, v in options.items():
-            text += "{}{}".format(v, " " * (30 - len(v)))
-            if k in self.data["display"]:
-                text += f"/hide_0{k}\n"
-            else:
-                text += f"/show_0{k}\n"
-        return text
+        return display_text(self.masks["display"])
 
 
 class Practice:
     """
-    Practice class generates PracticeItem based on practice settings
+    Practice class generates PracticeItem based on practice settings.
+    Given a user`s stats, items are picked adaptively, otherwise uniformly.
     """
 
-    def __init__(self, settings: PracticeSettings, item_type: str):
+    def __init__(
+        self,
+        settings: PracticeSettings,
+        item_type: str,
+        catalog: PracticeCatalog,
+        stats=None,
+    ):
         self.log = get_logger()
         self.settings = settings
         self.item_type = item_type
+        if item_type not in catalog.tables:
+            raise NotImplementedError
+        self.table = catalog.tables[item_type]
+        self.selector = None
+        if stats is not None:
+            self.selector = AdaptiveSelector(self.table, settings, stats)
 
     def generate(self) -> PracticeItem:
         """
         Generate a ParcticeItem (mode or chord) based on user`s practice settings
         """
-        selected_item = selected_type = item_id = text = None
-
-        if self.item_type == "MODES":
-            selected_items = (
-                self.settings.data["modes"]
-                if len(self.settings.data["modes"]) < 5
-                else sample(self.settings.data["modes"], 5)
-            )
-            selected_item = choice(selected_items)
-            selected_type = choice(self.settings.data["modes_types"])
-            item_id = "03"
-            text = {
-                0: [str(MODES[i]) for i in selected_items],
-                1: MODES[selected_item],
-                2: MODES_TYPES[selected_type],
-                3: MODES_LONG[selected_item],
-            }
-        elif self.item_type == "CHORDS":
-            selected_items = (
-                self.settings.data["chords"]
-                if len(self.settings.data["chords"]) < 5
-                else sample(self.settings.data["chords"], 5)
-            )
-            selected_item = choice(selected_items)
-            selected_type = choice(self.settings.data["chord_inversions"])
-            item_id = "04"
-            text = {
-                0: [str(CHORDS[i]) for i in selected_items],
-                1: CHORDS[selected_item],
-                2: CHORD_INVERSIONS[selected_type],
-                3: CHORDS[selected_item],
-            }
+        t = self.table
+        items = self.settings.get(t.items_setting)
+        picked = None if self.selector is None else self.selector.sample()
+        if picked is None:
+            # combinations without an audio on the host are picked again
+            for _ in range(MAX_PICKS):
+                selected_items = items if len(items) < 5 else sample(items, 5)
+                selected_item = choice(selected_items)
+                selected_type = choice(self.settings.get(t.variants_setting))
+                scales = t.scales_for(selected_item, selected_type)
+                if scales:
+                    break
         else:
-            raise NotImplementedError
-
-        self.log.debug(f"{self.item_type} selected: {selected_item}")
-        self.log.debug(f"{self.item_type} type selected: {selected_type}")
-
-        sd = randint(0, len(SCALES) - 1)
-        self.log.debug("scale selected: {}({})".format(SCALES[sd], sd))
-
-        file_id = f"{item_id}{sd:02}{selected_item:02}"
-
-        audio_file_id = f"{file_id}{selected_type:02}.mp3"
-        self.log.debug(f"generate audio id:{audio_file_id}")
+            selected_item, selected_type = picked
+            scales = t.scales_for(selected_item, selected_type)
+            if len(items) < 5:
+                selected_items = items
+            else:
+                selected_items = sample([i for i in items if i != selected_item], 4)
+                selected_items.insert(randrange(5), selected_item)
+        if not scales:
+            self.log.warning(f"{self.item_type}: no audio for the practice settings")
+            scales = range(t.n_scales)
+        sd = choice(scales)
+        img = t.image_index(sd, selected_item)
 
-        audio_url = (
-            f"{self.settings.data['HOST']}/audio/{item_id}/{sd + 1:02}/{audio_file_id}"
+        self.log.debug(
+            "%s selected: %s type: %s scale: %s",
+            self.item_type,
+            selected_item,
+            selected_type,
+            sd,
         )
-        self.log.debug(f"audio url:{audio_url}")
-
-        img_file_id = f"{file_id}00.jpg"
-        self.log.debug(f"generate keyboard img id:{img_file_id}")
-
-        img_url = f"{self.settings.data['HOST']}/img/{item_id}/{sd + 1:02}/{img_file_id}"
-        self.log.debug(f"keyboard img url:{img_url}")
-
-        img_url2 = f"{img_url[:-5]}1.png"
-        self.log.debug(f"notes img url:{img_url2}")
 
         return PracticeItem(
             self.item_type,
-            audio_url,
-            img_url,
-            img_url2,
+            t.audio[t.index(sd, selected_item, selected_type)],
+            t.img[img],
+            t.img2[img],
             sd,
-            SCALES[sd],
-            list(text[0]),
+            t.scales[sd],
+            [t.items[i] for i in selected_items],
             selected_item,
-            str(text[1]),
+            t.items[selected_item],
             selected_type,
-            str(text[2]),
+            t.variants[selected_type],
             selected_item,
-            str(text[3]),
+            t.long_names[selected_item],
         )
@@ -0,0 +1,98 @@
+"""
+The Telegram client`s HTTP connection pool
+"""
+import socket
+import threading
+from time import perf_counter
+
+from telegram.utils.request import Request
+
+from lib.logger import get_logger
+from lib.metrics import Registry
+
+
+def required_pool_size(workers: int, io_workers: int, cleanup_workers: int) -> int:
+    """
+    Connections needed for all threads that may make requests at the same time:
+    handlers` io workers, the cleaner`s workers, the updater and the dispatcher,
+    at least the size python-telegram-bot expects for its workers
+    """
+    return max(workers + 4, io_workers + cleanup_workers + 2)
+
+
+class PooledRequest(Request):
+    """
+    python-telegram-bot`s Request that makes at most con_pool_size requests
+    at the same time: a request waits for a pooled connection instead of
+    opening a new one that is discarded afterwards. The waiting time is
+    observed in metrics.
+    """
+
+    # python-telegram-bot warns about attributes not declared in slots
+    __slots__ = ("log", "gate", "in_use", "lock", "pool_wait")
+
+    def __init__(
+        self,
+        con_pool_size: int = 8,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 5.0,
+        keep_alive_idle: int = 120,
+        metrics: Registry = None,
+    ):
+        """
+        Keyword arguments:
+        con_pool_size -- number of kept-alive connections
+        connect_timeout -- seconds to establish a connection
+        read_timeout -- seconds to wait for a response, unless a method sets it
+        keep_alive_idle -- seconds of idle before TCP keep-alive probes, 0 is off
+        metrics -- a registry for the pool metrics
+        """
+        super().__init__(
+            con_pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout
+        )
+        self.log = get_logger()
+        self.set_keep_alive(keep_alive_idle)
+        self.gate = threading.BoundedSemaphore(con_pool_size)
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+        metrics = metrics if metrics is not None else Registry()
+        self.pool_wait = metrics.histogram(
+            "pool_wait_seconds", "Time a request waited for a pooled connection"
+        )
+        metrics.gauge_fn(
+            "pool_in_use", "Pooled connections in use", lambda: self.in_use
+        )
+        metrics.gauge_fn("pool_size", "Connection pool size", lambda: con_pool_size)
+
+    def set_keep_alive(self, idle: int) -> None:
+        """
+        Replace python-telegram-bot`s TCP keep-alive idle time of new connections
+        """
+        pool_kw = getattr(self._con_pool, "connection_pool_kw", None)
+        if pool_kw is None or not hasattr(socket, "TCP_KEEPIDLE"):
+            return
+        options = [
+            o
+            for o in pool_kw.get("socket_options", [])
+            if o[:2] != (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE)
+        ]
+        if idle:
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle)))
+        else:
+            options = [
+                o for o in options if o[:2] != (socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+            ]
+        pool_kw["socket_options"] = options
+
+    def _request_wrapper(self, *args, **kwargs) -> bytes:
+        start = perf_counter()
+        with self.gate:
+            self.pool_wait.observe(perf_counter() - start)
+            with self.lock:
+                self.in_use += 1
+            try:
+                return super()._request_wrapper(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.in_use -= 1
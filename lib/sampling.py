@@ -0,0 +1,157 @@
+"""
+Weighted random selection of practice items, adapted to a user`s answers
+"""
+from random import randrange
+
+from lib.catalog import CatalogTable
+from lib.logger import get_logger, trace
+
+# weight of an (item, variant) with an error rate of 1.0
+WEIGHT_SCALE = 1000
+
+
+class FenwickTree:
+    """
+    A binary indexed tree over integer weights:
+    O(log n) weight updates and weighted sampling
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.weights = [0] * size
+        self.total = 0
+        # the highest power of two not above size, the first step of a search
+        self.top = 1 << (size.bit_length() - 1) if size else 0
+
+    def build(self, weights: list) -> None:
+        """
+        Replace all weights, O(n)
+        """
+        self.weights = list(weights)
+        self.tree = [0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+
+    def set(self, index: int, weight: int) -> None:
+        """
+        Set a weight of an index
+        """
+        delta = weight - self.weights[index]
+        if not delta:
+            return
+        self.weights[index] = weight
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value: int) -> int:
+        """
+        The first index whose cumulative weight is above value
+        """
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= value:
+                pos = nxt
+                value -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+    def sample(self) -> int:
+        """
+        A random index with a probability proportional to its weight,
+        None if all weights are zero
+        """
+        if self.total <= 0:
+            return None
+        return self.find(randrange(self.total))
+
+
+class AdaptiveSelector:
+    """
+    Picks (item, variant) combinations of a practice type weighted by the user`s
+    error rate on them: often missed combinations come up more often,
+    well known ones less often, never answered ones in between.
+    Weights are updated as the user answers and rebuilt when the settings change.
+    """
+
+    def __init__(self, table: CatalogTable, settings, stats):
+        """
+        Keyword arguments:
+        table -- a catalog table of the practice type
+        settings -- the user`s PracticeSettings
+        stats -- the user`s UserStats
+        """
+        self.log = get_logger()
+        self.table = table
+        self.name = table.items_setting
+        self.variants_setting = table.variants_setting
+        self.n_items = table.n_items
+        self.n_variants = table.n_variants
+        self.settings = settings
+        self.stats = stats
+        self.tree = FenwickTree(self.n_items * self.n_variants)
+        self.masks = None
+        self.stats.listeners[self.name] = self.on_result
+
+    def weight(self, item: int, variant: int) -> int:
+        """
+        A weight of a combination, its smoothed error rate,
+        zero if the combination has no audio on the assets host
+        """
+        if not self.table.scales_for(item, variant):
+            return 0
+        i = self.stats.index(self.name, item, variant)
+        right = self.stats.success[self.name][i]
+        wrong = self.stats.failed[self.name][i]
+        return max(1, WEIGHT_SCALE * (wrong + 1) // (right + wrong + 2))
+
+    @trace
+    def build(self) -> None:
+        """
+        Rebuild all weights for the currently selected items and variants
+        """
+        items_mask = self.settings.masks[self.name]
+        variants_mask = self.settings.masks[self.variants_setting]
+        self.masks = (items_mask, variants_mask)
+        weights = [0] * self.tree.size
+        for item in range(self.n_items):
+            if not items_mask >> item & 1:
+                continue
+            for variant in range(self.n_variants):
+                if variants_mask >> variant & 1:
+                    weights[item * self.n_variants + variant] = self.weight(
+                        item, variant
+                    )
+        self.tree.build(weights)
+
+    def on_result(self, item: int, variant: int) -> None:
+        """
+        Update a weight of an answered combination
+        """
+        i = item * self.n_variants + variant
+        if self.masks is not None and self.tree.weights[i]:
+            self.tree.set(i, self.weight(item, variant))
+
+    def sample(self) -> tuple:
+        """
+        Pick an (item, variant) combination,
+        None if no selected combination has an audio
+        """
+        masks = (
+            self.settings.masks[self.name],
+            self.settings.masks[self.variants_setting],
+        )
+        if masks != self.masks:
+            self.build()
+        index = self.tree.sample()
+        if index is None:
+            return None
+        return divmod(index, self.n_variants)
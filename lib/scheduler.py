@@ -0,0 +1,60 @@
+"""
+Per-chat ordered execution of the bot`s handlers
+"""
+import asyncio
+
+from lib.logger import get_logger
+
+
+class ChatScheduler:
+    """
+    Runs coroutines of the same chat one after another, in the order they arrived,
+    while different chats run in parallel up to max_concurrency at a time.
+    All methods must be called on the event loop.
+    """
+
+    def __init__(self, max_concurrency: int = 64):
+        """
+        Keyword arguments:
+        max_concurrency -- maximum number of coroutines running at the same time
+        """
+        self.log = get_logger()
+        self.max_concurrency = max_concurrency
+        # created on the event loop: before python 3.10 a semaphore is bound
+        # to the loop of the thread that creates it
+        self.semaphore = None
+        # chat_id -> a future done when the last scheduled coroutine of the chat ends
+        self.tails = {}
+        self.waiting = 0
+        self.running = 0
+
+    async def run(self, chat_id: int, coro):
+        """
+        Run a coroutine after all previously scheduled coroutines of the chat
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        previous = self.tails.get(chat_id)
+        done = asyncio.get_running_loop().create_future()
+        self.tails[chat_id] = done
+        self.waiting += 1
+        started = False
+        try:
+            if previous is not None:
+                # asyncio.wait does not cancel the previous one if this one is cancelled
+                await asyncio.wait([previous])
+            async with self.semaphore:
+                self.waiting -= 1
+                self.running += 1
+                started = True
+                try:
+                    return await coro
+                finally:
+                    self.running -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+                coro.close()
+            done.set_result(None)
+            if self.tails.get(chat_id) is done:
+                del self.tails[chat_id]
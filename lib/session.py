@@ -0,0 +1,238 @@
+"""
+A bounded cache of chat sessions and an index of recently active chats
+"""
+import json
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+
+from lib.logger import get_logger, trace
+from lib.storage import atomic_write
+
+
+class SessionCache:
+    """
+    A bounded LRU cache of chat sessions with idle eviction.
+    A missing session is created by the loader on the first access,
+    an evicted session is passed to on_evict to be stored.
+    """
+
+    def __init__(
+        self,
+        loader,
+        on_evict=None,
+        max_size: int = 10000,
+        idle_ttl: float = 3600.0,
+    ):
+        """
+        Keyword arguments:
+        loader -- a function (chat_id) -> session
+        on_evict -- a function (chat_id, session) called when a session is evicted
+        max_size -- maximum number of sessions in memory
+        idle_ttl -- seconds of inactivity after which a session is evicted
+        """
+        self.log = get_logger()
+        self.loader = loader
+        self.on_evict = on_evict
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        # chat_id -> [session, last access time], the least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __getitem__(self, chat_id: int) -> dict:
+        with self.lock:
+            entry = self.sessions.get(chat_id)
+            if entry is not None:
+                entry[1] = monotonic()
+                self.sessions.move_to_end(chat_id)
+                return entry[0]
+
+        session = self.loader(chat_id)
+        with self.lock:
+            # another thread could load the same session meanwhile
+            entry = self.sessions.setdefault(chat_id, [session, monotonic()])
+        self.evict()
+        return entry[0]
+
+    def __setitem__(self, chat_id: int, session: dict) -> None:
+        with self.lock:
+            self.sessions[chat_id] = [session, monotonic()]
+            self.sessions.move_to_end(chat_id)
+        self.evict()
+
+    @trace
+    def evict(self) -> int:
+        """
+        Evict idle sessions and the least recently used ones above max_size,
+        return the number of evicted sessions
+        """
+        evicted = []
+        deadline = monotonic() - self.idle_ttl
+        with self.lock:
+            while self.sessions:
+                chat_id, entry = next(iter(self.sessions.items()))
+                if len(self.sessions) <= self.max_size and entry[1] > deadline:
+                    break
+                del self.sessions[chat_id]
+                evicted.append((chat_id, entry[0]))
+
+        for chat_id, session in evicted:
+            self.log.debug(f"evict session {chat_id}")
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(chat_id, session)
+                except Exception as e:
+                    self.log.exception(f"unable to evict session {chat_id}: {e}")
+        return len(evicted)
+
+    def clear(self) -> None:
+        """
+        Evict all sessions
+        """
+        max_size, self.max_size = self.max_size, 0
+        try:
+            self.evict()
+        finally:
+            self.max_size = max_size
+
+
+class ChatStates:
+    """
+    A bounded LRU map of chats` conversation states {chat_id: state},
+    the least recently active chats are dropped and start over from the menu.
+    All methods must be called on the event loop.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        """
+        Keyword arguments:
+        max_size -- maximum number of chats with a state
+        """
+        self.max_size = max_size
+        # chat_id -> state, the least recently used first
+        self.states = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def get(self, chat_id: int):
+        """
+        A chat`s state, None for a new, a cancelled or a dropped chat
+        """
+        state = self.states.get(chat_id)
+        if state is not None:
+            self.states.move_to_end(chat_id)
+        return state
+
+    def set(self, chat_id: int, state) -> None:
+        """
+        Set a chat`s state, None forgets the chat
+        """
+        if state is None:
+            self.states.pop(chat_id, None)
+            return
+        self.states[chat_id] = state
+        self.states.move_to_end(chat_id)
+        while len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+
+
+class ActiveUsers:
+    """
+    An index of recently active chats {chat_id: last activity time},
+    persisted so sessions of active users can be preloaded after a restart
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/active_users.json",
+        max_size: int = 100000,
+        save_delay: float = 60.0,
+    ):
+        """
+        Keyword arguments:
+        path -- a json file with the index
+        max_size -- maximum number of chats in the index
+        save_delay -- seconds to collect activity before saving the index
+        """
+        self.log = get_logger()
+        self.path = path
+        self.max_size = max_size
+        self.save_delay = save_delay
+        # chat_id -> last activity time, the least recently active first
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def load(self) -> None:
+        """
+        Load the index from a json file
+        """
+        try:
+            with open(self.path, "r") as f:
+                users = json.load(f)
+        except (OSError, ValueError) as e:
+            self.log.info(f"active users index not loaded: {e}")
+            return
+        # stored as [[chat_id, time], ...]
+        loaded = OrderedDict(sorted(users, key=lambda user: user[1]))
+        with self.lock:
+            # chats active since the start are more recent than the stored ones
+            for chat_id, ts in self.users.items():
+                loaded[chat_id] = ts
+                loaded.move_to_end(chat_id)
+            self.users = loaded
+            while len(self.users) > self.max_size:
+                self.users.popitem(last=False)
+
+    def touch(self, chat_id: int) -> None:
+        """
+        Record activity of a chat
+        """
+        now = int(time())
+        with self.lock:
+            if self.users.get(chat_id) == now:
+                return
+            self.users[chat_id] = now
+            self.users.move_to_end(chat_id)
+            while len(self.users) > self.max_size:
+                self.users.popitem(last=False)
+            if self.timer is None:
+                self.timer = threading.Timer(self.save_delay, self.save)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def recent(self, max_age: float, limit: int) -> list:
+        """
+        Chats active within max_age seconds, the most recently active first
+        """
+        oldest = time() - max_age
+        chats = []
+        with self.lock:
+            for chat_id, ts in reversed(self.users.items()):
+                if ts < oldest or len(chats) >= limit:
+                    break
+                chats.append(chat_id)
+        return chats
+
+    @trace
+    def save(self) -> None:
+        """
+        Save the index to a json file
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            text = json.dumps([[chat_id, ts] for chat_id, ts in self.users.items()])
+        try:
+            atomic_write(self.path, text)
+        except OSError as e:
+            self.log.warning(f"unable to save active users index: {e}")
@@ -0,0 +1,289 @@
+"""
+Users` profiles storage backends: one json file per user or an SQLite database
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+
+from lib.logger import get_logger, trace
+
+# practice settings names and their keys in a json profile
+SETTINGS_KEYS = {
+    "modes": "practice_modes",
+    "modes_types": "practice_modes_types",
+    "chords": "practice_chords",
+    "chord_inversions": "practice_chord_inversions",
+    "display": "practice_display",
+}
+
+
+def atomic_write(path: str, text: str) -> None:
+    """
+    Replace a file atomically (temp file + rename),
+    so a crash never leaves a truncated file
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}."
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class UserStorage(ABC):
+    """
+    A base class of users` profiles storage.
+    A profile is a dict in the json profile format.
+    """
+
+    # True if the storage can apply single answers and settings changes
+    # without rewriting a whole profile, it then has an apply(ops) method
+    incremental = False
+
+    @abstractmethod
+    def load(self, user_id: int) -> dict:
+        """
+        Load a user`s profile, return None if not exists
+        """
+
+    @abstractmethod
+    def save(self, user_id: int, profile: dict) -> None:
+        """
+        Save a whole user`s profile
+        """
+
+    @abstractmethod
+    def user_ids(self):
+        """
+        Iterate over all stored users` ids
+        """
+
+    def close(self) -> None:
+        """
+        Release the storage resources
+        """
+
+
+class JsonStorage(UserStorage):
+    """
+    One json file per user: <path>/<user_id>
+    """
+
+    def __init__(self, path: str = "users"):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def user_path(self, user_id: int) -> str:
+        """
+        A path to a user`s json file
+        """
+        return os.path.join(self.path, str(user_id))
+
+    @trace
+    def load(self, user_id: int) -> dict:
+        try:
+            with open(self.user_path(user_id), "r") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    @trace
+    def save(self, user_id: int, profile: dict) -> None:
+        atomic_write(self.user_path(user_id), json.dumps(profile))
+
+    def user_ids(self):
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lstrip("-").isdigit():
+                    yield int(entry.name)
+
+
+class SQLiteStorage(UserStorage):
+    """
+    An SQLite (WAL mode) storage: an answer is a counter update
+    and a settings change touches only its own row
+    """
+
+    incremental = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            items TEXT NOT NULL,
+            PRIMARY KEY (user_id, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS answers (
+            user_id INTEGER NOT NULL,
+            practice TEXT NOT NULL,
+            item TEXT NOT NULL,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, practice, item)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, database: str = "users/users.db"):
+        self.log = get_logger()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            database, check_same_thread=False, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    @trace
+    def load(self, user_id: int) -> dict:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT user_name FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            settings = self.db.execute(
+                "SELECT name, items FROM settings WHERE user_id = ?", (user_id,)
+            ).fetchall()
+            answers = self.db.execute(
+                "SELECT practice, item, success, failed FROM answers WHERE user_id = ?",
+                (user_id,),
+            ).fetchall()
+
+        profile = {
+            "success_answers": {"chords": {}, "modes": {}},
+            "failed_answers": {"chords": {}, "modes": {}},
+            "id": user_id,
+            "profile": {"user_name": row[0]},
+        }
+        for name, items in settings:
+            profile[SETTINGS_KEYS[name]] = json.loads(items)
+        for practice, item, success, failed in answers:
+            profile["success_answers"].setdefault(practice, {})[item] = success
+            profile["failed_answers"].setdefault(practice, {})[item] = failed
+        return profile
+
+    @trace
+    def save(self, user_id: int, profile: dict) -> None:
+        self.save_many([(user_id, profile)])
+
+    def save_many(self, profiles: list) -> None:
+        """
+        Save a list of (user_id, profile) in a single transaction
+        """
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for user_id, profile in profiles:
+                    self.save_profile(user_id, profile)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def save_profile(self, user_id: int, profile: dict) -> None:
+        """
+        Replace all rows of a user, must be called inside a transaction
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO users (id, user_name) VALUES (?, ?)",
+            (user_id, profile["profile"]["user_name"]),
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO settings (user_id, name, items) VALUES (?, ?, ?)",
+            [
+                (user_id, name, json.dumps(profile[key]))
+                for name, key in SETTINGS_KEYS.items()
+                if key in profile
+            ],
+        )
+        self.db.execute("DELETE FROM answers WHERE user_id = ?", (user_id,))
+        self.db.executemany(
+            "INSERT INTO answers (user_id, practice, item, success, failed)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    user_id,
+                    practice,
+                    item,
+                    success,
+                    profile["failed_answers"].get(practice, {}).get(item, 0),
+                )
+                for practice, stats in profile["success_answers"].items()
+                for item, success in stats.items()
+            ],
+        )
+
+    @trace
+    def apply(self, ops: list) -> None:
+        """
+        Apply incremental changes:
+        ("answer", user_id, name, keys, success) or ("settings", user_id, name, items)
+        """
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for op in ops:
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO users (id, user_name) VALUES (?, ?)",
+                        (op[1], "default"),
+                    )
+                    if op[0] == "answer":
+                        _, user_id, name, keys, success = op
+                        self.db.executemany(
+                            "INSERT INTO answers"
+                            " (user_id, practice, item, success, failed)"
+                            " VALUES (?, ?, ?, ?, ?)"
+                            " ON CONFLICT (user_id, practice, item) DO UPDATE SET"
+                            " success = success + excluded.success,"
+                            " failed = failed + excluded.failed",
+                            [
+                                (user_id, name, str(k), int(success), int(not success))
+                                for k in keys
+                            ],
+                        )
+                    elif op[0] == "settings":
+                        _, user_id, name, items = op
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO settings (user_id, name, items)"
+                            " VALUES (?, ?, ?)",
+                            (user_id, name, json.dumps(items)),
+                        )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def user_ids(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id FROM users").fetchall()
+        for (user_id,) in rows:
+            yield user_id
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def create_storage(settings: dict) -> UserStorage:
+    """
+    Create a storage from the "storage" section of the config
+    """
+    backend = settings.get("backend", "json")
+    if backend == "json":
+        return JsonStorage(settings.get("path", "users"))
+    if backend == "sqlite":
+        return SQLiteStorage(settings.get("database", "users/users.db"))
+    raise ValueError(f"unknown storage backend: {backend}")
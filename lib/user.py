@@ -1,59 +1,201 @@
 """
 A user realted storage and functionality
 """
-import json
+import threading
+from array import array
 from dataclasses import dataclass
 
 from lib.logger import get_logger, trace
 from lib.practice import PracticeSettings
+from lib.storage import SETTINGS_KEYS, JsonStorage, UserStorage
+from lib.theory import CHORD_INVERSIONS, CHORDS, MODES, MODES_TYPES
+
+# practice name -> (items, variants) the statistics are kept for
+STATS_TABLES = {"chords": (CHORDS, CHORD_INVERSIONS), "modes": (MODES, MODES_TYPES)}
+# practice name -> (item name -> id, variant name -> id)
+STATS_NAMES = {
+    name: ({v: k for k, v in items.items()}, {v: k for k, v in variants.items()})
+    for name, (items, variants) in STATS_TABLES.items()
+}
 
 
 class UserStats:
     """
-    User`s statistic class that stores guessed or not guessed chords and modes
+    User`s statistic class that stores guessed or not guessed chords and modes.
+    Counters are kept in flat integer arrays, one row per item:
+    the item total followed by a counter per variant (chord inversion, mode direction)
     """
 
-    success_answers: dict = {"chords": {}, "modes": {}}
-    failed_answers: dict = {"chords": {}, "modes": {}}
-
     def __init__(self):
         self.log = get_logger()
+        self.success = {}
+        self.failed = {}
+        for name, (items, variants) in STATS_TABLES.items():
+            size = len(items) * (len(variants) + 1)
+            self.success[name] = array("I", bytes(4 * size))
+            self.failed[name] = array("I", bytes(4 * size))
+        # counters of items unknown to the theory tables, kept as loaded
+        self.extra = {"success": {}, "failed": {}}
+        # rendered stats lines of answered items, only lines of items changed
+        # by result() are rebuilt on the next prepare_stats()
+        self.lines = {
+            name: [None] * len(items) for name, (items, _) in STATS_TABLES.items()
+        }
+        self.extra_lines = {}
+        self.stale = set()
+        self.text = None
+        # practice name -> a callback(item, variant) called on every result()
+        self.listeners = {}
 
-    @trace
-    def add_new(self, name: str, chord: int) -> None:
+    @staticmethod
+    def index(name: str, item: int, variant: int = None) -> int:
         """
-        Add a new element (chord or mode) to the statistics if not exists
+        An index of an item total (or of its variant) counter
         """
-        if chord not in self.success_answers[name]:
-            self.success_answers[name][chord] = self.failed_answers[name][chord] = 0
+        row = item * (len(STATS_TABLES[name][1]) + 1)
+        return row if variant is None else row + 1 + variant
+
+    @staticmethod
+    def keys(name: str, item: int, variant: int) -> list:
+        """
+        Json keys of an item and its variant counters
+        """
+        items, variants = STATS_TABLES[name]
+        return [items[item], f"{items[item]}:{variants[variant]}"]
 
     @trace
-    def result(self, succeess: bool, name: str, chord: int, ctype: int) -> None:
+    def result(self, succeess: bool, name: str, item: int, variant: int) -> None:
         """
         Fail or pass a given chord or mode
         """
-        for c in [chord, f"{chord}:{ctype}"]:
-            self.add_new(name, c)
-            if succeess:
-                self.success_answers[name][c] += 1
-            else:
-                self.failed_answers[name][c] += 1
+        counters = self.success[name] if succeess else self.failed[name]
+        row = self.index(name, item)
+        counters[row] += 1
+        counters[row + 1 + variant] += 1
+        self.stale.add((name, item))
+        self.text = None
+        listener = self.listeners.get(name)
+        if listener is not None:
+            listener(item, variant)
+
+    @staticmethod
+    def format_line(item_name: str, right: int, wrong: int) -> str:
+        return "{:<20} {:>20}\n".format(item_name, f"right:{right} wrong:{wrong}")
+
+    def render_line(self, name: str, item: int) -> None:
+        """
+        Rebuild a stats line of an item
+        """
+        row = self.index(name, item)
+        right, wrong = self.success[name][row], self.failed[name][row]
+        self.lines[name][item] = self.format_line(
+            STATS_TABLES[name][0][item], right, wrong
+        )
+
+    def to_dict(self, success: bool) -> dict:
+        """
+        Success or failed counters in the json format:
+        {name: {item: n, "item:variant": n}} for answered items only
+        """
+        data = {}
+        for name, (items, variants) in STATS_TABLES.items():
+            counters = self.success[name] if success else self.failed[name]
+            others = self.failed[name] if success else self.success[name]
+            stats = data[name] = {}
+            for item, item_name in items.items():
+                for variant in [None] + list(variants):
+                    i = self.index(name, item, variant)
+                    if counters[i] or others[i]:
+                        if variant is not None:
+                            stats[f"{item_name}:{variants[variant]}"] = counters[i]
+                        else:
+                            stats[item_name] = counters[i]
+        for name, stats in self.extra["success" if success else "failed"].items():
+            data.setdefault(name, {}).update(stats)
+        return data
+
+    @property
+    def success_answers(self) -> dict:
+        return self.to_dict(True)
+
+    @property
+    def failed_answers(self) -> dict:
+        return self.to_dict(False)
+
+    def load(self, success_answers: dict, failed_answers: dict) -> None:
+        """
+        Load counters from the json format
+        """
+        for kind, data in (("success", success_answers), ("failed", failed_answers)):
+            counters = getattr(self, kind)
+            for name, stats in data.items():
+                if name not in STATS_TABLES:
+                    self.extra[kind][name] = dict(stats)
+                    continue
+                for key, value in stats.items():
+                    i = self.key_index(name, str(key))
+                    if i is None:
+                        self.extra[kind].setdefault(name, {})[key] = value
+                    else:
+                        counters[name][i] = value
+        self.render()
+
+    def render(self) -> None:
+        """
+        Rebuild all stats lines
+        """
+        for name, (items, _) in STATS_TABLES.items():
+            for item in items:
+                row = self.index(name, item)
+                if self.success[name][row] or self.failed[name][row]:
+                    self.render_line(name, item)
+        failed = self.extra["failed"]
+        self.extra_lines = {
+            name: [
+                self.format_line(k, v, failed.get(name, {}).get(k, 0))
+                for k, v in stats.items()
+                if ":" not in str(k)
+            ]
+            for name, stats in self.extra["success"].items()
+        }
+        self.text = None
+
+    @staticmethod
+    def key_index(name: str, key: str) -> int:
+        """
+        An index of a json key counter, None if the item is unknown
+        """
+        item_name, _, variant_name = key.partition(":")
+        item = STATS_NAMES[name][0].get(item_name)
+        if item is None:
+            return None
+        if not variant_name:
+            return UserStats.index(name, item)
+        variant = STATS_NAMES[name][1].get(variant_name)
+        return None if variant is None else UserStats.index(name, item, variant)
 
     @trace
     def prepare_stats(self) -> str:
         """
         Prepare the statistics information for a user to display
         """
-        txt = ""
-        for name, stats in self.success_answers.items():
-            txt += f"{name}:\n"
-            for k, v in stats.items():
-                if ":" in str(k):
-                    continue
-                right = f"right:{v} wrong:{self.failed_answers[name][k]}"
-                txt += "{:<20} {:>20}\n".format(k, right)
-            txt += "\n"
-        return txt
+        if self.text is None:
+            for name, item in self.stale:
+                self.render_line(name, item)
+            self.stale.clear()
+            parts = []
+            for name, lines in self.lines.items():
+                parts.append(f"{name}:\n")
+                parts.extend(line for line in lines if line is not None)
+                parts.extend(self.extra_lines.get(name, ()))
+                parts.append("\n")
+            for name, lines in self.extra_lines.items():
+                if name not in self.lines:
+                    parts.append(f"{name}:\n")
+                    parts.extend(lines)
+                    parts.append("\n")
+            self.text = "".join(parts)
+        return self.text
 
 
 @dataclass
@@ -87,39 +229,96 @@ class User:
 
 class UserManager:
     """
-    A manager class that handles load and save of a user`s profile
+    A manager class that handles load and save of a user`s profile.
+    Changes are queued and written in the background (write-behind),
+    so many answers are coalesced into a single write.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        storage: UserStorage = None,
+        flush_interval: float = 5.0,
+        flush_threshold: int = 100,
+    ):
+        """
+        Keyword arguments:
+        storage -- a users` profiles storage (json files by default)
+        flush_interval -- seconds between background flushes
+        flush_threshold -- flush earlier once this many changes are queued
+        """
         self.log = get_logger()
+        self.storage = storage if storage is not None else JsonStorage()
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        # whole profiles to save
+        self.dirty = {}
+        # incremental changes for storages that support them
+        self.ops = []
+        self.ops_users = set()
+        # profiles and users of changes being written by a flush
+        self.in_flight = {}
+        self.in_flight_ops = set()
+        self.lock = threading.Lock()
+        # flushes run one at a time, a later one waits for the writes of an earlier
+        self.flushing = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.writer = None
+        # totals of written changes and of flushes, for metrics
+        self.written = 0
+        self.flushes = 0
+
+    @staticmethod
+    def to_profile(user_id: int, data: User) -> dict:
+        """
+        Convert a user to the json profile format
+        """
+        profile = {
+            "success_answers": data.stats.success_answers,
+            "failed_answers": data.stats.failed_answers,
+            "id": user_id,
+            "profile": {"user_name": data.profile.user_name},
+        }
+        for name, key in SETTINGS_KEYS.items():
+            profile[key] = list(data.settings.get(name))
+        return profile
+
+    @staticmethod
+    def from_profile(user_id: int, profile: dict) -> User:
+        """
+        Create a user from the json profile format
+        """
+        data = User(user_id, profile["profile"]["user_name"])
+        data.stats.load(profile["success_answers"], profile["failed_answers"])
+        for name, key in SETTINGS_KEYS.items():
+            if key in profile:
+                data.settings.set(name, profile[key])
+        return data
 
     @trace
     def load_user(self, user_id: int) -> User:
         """
-        Load a user profile from a json file or create a new one if not exists
+        Load a user profile from the storage or create a new one if not exists
         """
+        with self.lock:
+            # a profile that was not written yet is newer than the stored one
+            if user_id in self.dirty:
+                return self.dirty[user_id]
+            if user_id in self.in_flight:
+                return self.in_flight[user_id]
+            pending_ops = user_id in self.ops_users or user_id in self.in_flight_ops
+        if pending_ops:
+            self.flush()
+
         data = None
         try:
-            with open(f"users/{str(user_id)}", "r") as f:
-                rd = f.read()
-                dict_data = json.loads(rd)
-                data = User(user_id, dict_data["profile"]["user_name"])
-                data.profile = UserProfile(dict_data["profile"]["user_name"])
-                data.profile.user_name = dict_data["profile"]["user_name"]
-                data.stats = UserStats()
-                data.stats.failed_answers = dict_data["failed_answers"]
-                data.stats.success_answers = dict_data["success_answers"]
-                data.settings = PracticeSettings()
-                data.settings.data["modes"] = dict_data["practice_modes"]
-                data.settings.data["modes_types"] = dict_data["practice_modes_types"]
-                data.settings.data["chords"] = dict_data["practice_chords"]
-                data.settings.data["chord_inversions"] = dict_data[
-                    "practice_chord_inversions"
-                ]
-                data.settings.data["display"] = dict_data["practice_display"]
+            profile = self.storage.load(user_id)
+            if profile is not None:
+                data = self.from_profile(user_id, profile)
         except Exception as e:
             # Unable to load a profile.Will create a default one
             self.log.exception(e)
+        if data is None:
             self.log.warning(f"nothing to load. creating a new user {user_id}")
             data = User(user_id, "default")
 
@@ -128,20 +327,135 @@ class UserManager:
     @trace
     def save_user(self, user_id: int, data: User) -> None:
         """
-        Save user`s profile to a json file
+        Save a whole user`s profile to the storage right away
         """
-        dict_data = {
-            "success_answers": data.stats.success_answers,
-            "failed_answers": data.stats.failed_answers,
-            "id": user_id,
-            "profile": {"user_name": data.profile.user_name},
-            "practice_modes": data.settings.data["modes"],
-            "practice_modes_types": data.settings.data["modes_types"],
-            "practice_chords": data.settings.data["chords"],
-            "practice_chord_inversions": data.settings.data["chord_inversions"],
-            "practice_display": data.settings.data["display"],
-        }
-        json_data = json.dumps(dict_data)
+        self.storage.save(user_id, self.to_profile(user_id, data))
 
-        with open(f"users/{str(user_id)}", "w") as f:
-            f.write(json_data)
+    @trace
+    def mark_dirty(self, user_id: int, data: User) -> None:
+        """
+        Schedule a whole user`s profile for the next background flush
+        """
+        with self.lock:
+            self.dirty[user_id] = data
+            if len(self.dirty) + len(self.ops) >= self.flush_threshold:
+                self.wakeup.set()
+
+    def queue_op(self, op: tuple) -> None:
+        """
+        Schedule an incremental change for the next background flush
+        """
+        with self.lock:
+            self.ops.append(op)
+            self.ops_users.add(op[1])
+            if len(self.dirty) + len(self.ops) >= self.flush_threshold:
+                self.wakeup.set()
+
+    @trace
+    def record_answer(
+        self,
+        user_id: int,
+        data: User,
+        succeess: bool,
+        name: str,
+        item: int,
+        variant: int,
+    ) -> None:
+        """
+        Update a user`s statistics with an answer and schedule it to be stored
+        """
+        data.stats.result(succeess, name, item, variant)
+        if self.storage.incremental:
+            keys = data.stats.keys(name, item, variant)
+            self.queue_op(("answer", user_id, name, keys, succeess))
+        else:
+            self.mark_dirty(user_id, data)
+
+    @trace
+    def settings_changed(self, user_id: int, data: User, name: str) -> None:
+        """
+        Schedule a changed practice setting to be stored
+        """
+        if self.storage.incremental:
+            self.queue_op(("settings", user_id, name, list(data.settings.get(name))))
+        else:
+            self.mark_dirty(user_id, data)
+
+    @trace
+    def flush(self) -> int:
+        """
+        Write all queued changes, return the number of written changes
+        """
+        with self.flushing:
+            written = self.write()
+        with self.lock:
+            self.written += written
+            self.flushes += 1
+        return written
+
+    def write(self) -> int:
+        """
+        Write queued changes, they are readable by load_user until written
+        """
+        with self.lock:
+            pending, self.dirty = self.dirty, {}
+            ops, self.ops = self.ops, []
+            self.in_flight_ops, self.ops_users = self.ops_users, set()
+            self.in_flight = dict(pending)
+
+        written = 0
+        if ops:
+            try:
+                self.storage.apply(ops)
+                written += len(ops)
+            except Exception as e:
+                self.log.warning(f"unable to apply {len(ops)} changes: {e}")
+                with self.lock:
+                    self.ops[:0] = ops
+                    self.ops_users.update(op[1] for op in ops)
+            with self.lock:
+                self.in_flight_ops = set()
+
+        for user_id, data in pending.items():
+            try:
+                self.save_user(user_id, data)
+                written += 1
+            except Exception as e:
+                # e.g. the stats changed while being serialized, retry next time
+                self.log.warning(f"unable to save user {user_id}: {e}")
+                with self.lock:
+                    self.dirty.setdefault(user_id, data)
+            with self.lock:
+                del self.in_flight[user_id]
+        return written
+
+    def run(self) -> None:
+        """
+        The background writer loop
+        """
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def start(self) -> None:
+        """
+        Start the background writer
+        """
+        self.stopped.clear()
+        self.writer = threading.Thread(
+            target=self.run, name="UserManagerWriter", daemon=True
+        )
+        self.writer.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background writer, flush all queued changes and close the storage
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        self.flush()
+        self.storage.close()
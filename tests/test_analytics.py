@@ -0,0 +1,57 @@
+"""
+Cross-user analytics reruns re-read only changed profiles
+"""
+import os
+
+from lib.storage import JsonStorage
+from tools import analytics
+
+
+def write_profile(storage: JsonStorage, user_id: int, right: int, wrong: int):
+    storage.save(
+        user_id,
+        {
+            "success_answers": {
+                "chords": {"maj7": right, "maj7:root - chord": right},
+                "modes": {},
+            },
+            "failed_answers": {
+                "chords": {"maj7": wrong, "maj7:root - chord": wrong},
+                "modes": {},
+            },
+            "id": user_id,
+            "profile": {"user_name": "someone"},
+        },
+    )
+
+
+def cold_run(src: str, state: str) -> dict:
+    total, _, _ = analytics.run(src, state, workers=1, shards=4)
+    return total
+
+
+def test_rerun_reads_only_changed_profiles(tmp_path):
+    src = str(tmp_path / "users")
+    state = str(tmp_path / "state")
+    storage = JsonStorage(src)
+    for user_id in range(20):
+        write_profile(storage, user_id, user_id % 3, 1)
+    with open(os.path.join(src, "99"), "w") as f:
+        f.write("{broken")
+
+    total, _, reread = analytics.run(src, state, workers=1, shards=4)
+    assert reread == 21
+    assert (total["users"], total["answered"], total["broken"]) == (20, 20, 1)
+    assert total["answers"]["chords"]["maj7"] == [19, 20, 20]
+    assert total["answers"]["chords"][":root - chord"] == [0, 0, 20]
+    assert analytics.run(src, state, workers=1, shards=4)[2] == 0
+
+    # the new profile has another size, so its signature changes
+    write_profile(storage, 5, 100, 0)
+    os.remove(os.path.join(src, "6"))
+    os.remove(os.path.join(src, "99"))
+    total, _, reread = analytics.run(src, state, workers=1, shards=4)
+    assert reread == 1
+    assert total == cold_run(src, str(tmp_path / "cold"))
+    assert (total["users"], total["broken"]) == (19, 0)
+    assert total["answers"]["chords"]["maj7"] == [19 - 2 - 0 + 100, 18, 19]
@@ -0,0 +1,47 @@
+"""
+Traced functions count every call and time the sampled ones
+"""
+import asyncio
+
+from lib.logger import configure_trace, get_trace_stats, trace
+
+
+def test_trace_counts_all_calls_and_samples_some():
+    @trace
+    def traced_sync():
+        pass
+
+    @trace
+    async def traced_async():
+        pass
+
+    @trace
+    def traced_rarely():
+        pass
+
+    async def main():
+        for _ in range(13):
+            await traced_async()
+
+    configure_trace(True, sample_rate=10)
+    try:
+        for _ in range(95):
+            traced_sync()
+        for _ in range(3):
+            traced_rarely()
+        asyncio.run(main())
+    finally:
+        configure_trace(False)
+
+    stats = get_trace_stats()
+    sync_name = traced_sync.__qualname__
+    async_name = traced_async.__qualname__
+    assert (stats[sync_name]["calls"], stats[sync_name]["sampled"]) == (95, 9)
+    assert (stats[async_name]["calls"], stats[async_name]["sampled"]) == (13, 1)
+    # reported before its first sampled call
+    rare_name = traced_rarely.__qualname__
+    assert (stats[rare_name]["calls"], stats[rare_name]["sampled"]) == (3, 0)
+
+    # calls are not counted while tracing is disabled
+    traced_sync()
+    assert get_trace_stats()[sync_name]["calls"] == 95
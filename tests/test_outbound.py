@@ -0,0 +1,120 @@
+"""
+Rate limits and the order of outbound requests
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from lib.outbound import BACKGROUND, REPLY, OutboundScheduler, SchedulerStopped
+
+
+def send_in_thread(scheduler, chat_id, priority, sent, name):
+    thread = threading.Thread(
+        target=scheduler.call, args=(chat_id, priority, sent.append, name)
+    )
+    thread.start()
+    return thread
+
+
+def test_replies_are_sent_before_background_requests():
+    # a token every 0.1s, so the threads are sent in the granted order
+    scheduler = OutboundScheduler(rate=10, burst=1, chat_rate=0)
+    scheduler.pause(0.3)
+    sent = []
+    threads = [send_in_thread(scheduler, None, BACKGROUND, sent, "background")]
+    time.sleep(0.05)
+    for i in range(3):
+        threads.append(send_in_thread(scheduler, 1, REPLY, sent, f"reply{i}"))
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join(5)
+    # replies in the order of arrival, then the earlier background request
+    assert sent == ["reply0", "reply1", "reply2", "background"]
+    assert scheduler.waiting == 0
+
+
+def test_chat_out_of_tokens_does_not_hold_back_other_chats():
+    scheduler = OutboundScheduler(rate=0, chat_rate=2, chat_burst=1)
+    sent = []
+    scheduler.call(1, REPLY, sent.append, "first")
+    # chat 1 has to wait about 0.5s for its next token
+    blocked = send_in_thread(scheduler, 1, REPLY, sent, "second")
+    time.sleep(0.05)
+    start = time.monotonic()
+    scheduler.call(2, REPLY, sent.append, "other chat")
+    assert time.monotonic() - start < 0.1
+    blocked.join(5)
+    assert sent == ["first", "other chat", "second"]
+
+
+def test_rate_limited_request_is_retried_after_a_pause():
+    scheduler = OutboundScheduler(rate=0, chat_rate=0, max_retries=2)
+    attempts = []
+
+    def send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.2)
+        return "ok"
+
+    assert scheduler.call(1, REPLY, send) == "ok"
+    assert attempts[1] - attempts[0] >= 0.2
+    assert scheduler.rate_limited.values[()] == 1
+
+    def always_limited():
+        raise RetryAfter(0.01)
+
+    with pytest.raises(RetryAfter):
+        scheduler.call(1, REPLY, always_limited)
+
+
+def test_many_waiters_are_sent_at_the_rate_in_order():
+    rate, n = 500, 1000
+
+    async def main():
+        scheduler = OutboundScheduler(rate=rate, burst=30, chat_rate=1)
+        sent = []
+
+        async def run(fn, *args):
+            return fn(*args)
+
+        start, cpu = time.monotonic(), time.process_time()
+        await asyncio.gather(
+            *[
+                scheduler.call_async(run, chat_id, REPLY, sent.append, chat_id)
+                for chat_id in range(n)
+            ]
+        )
+        return sent, time.monotonic() - start, time.process_time() - cpu
+
+    sent, elapsed, cpu = asyncio.run(main())
+    assert sent == list(range(n))
+    ideal = (n - 30) / rate
+    assert ideal * 0.9 <= elapsed < ideal + 1.0
+    # waiters are woken once, not on every token
+    assert cpu < 1.0
+
+
+def test_stop_fails_waiting_and_new_requests():
+    scheduler = OutboundScheduler(rate=0, chat_rate=0)
+    scheduler.pause(60)
+    errors = []
+
+    def send():
+        try:
+            scheduler.call(None, BACKGROUND, lambda: None)
+        except SchedulerStopped as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    time.sleep(0.05)
+    scheduler.stop()
+    thread.join(5)
+    assert not thread.is_alive() and len(errors) == 1
+    with pytest.raises(SchedulerStopped):
+        scheduler.call(None, BACKGROUND, lambda: None)
+    assert scheduler.waiting == 0
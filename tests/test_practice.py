@@ -0,0 +1,28 @@
+"""
+Practice settings accept only items of the theory tables
+"""
+from lib.catalog import PracticeCatalog
+from lib.practice import Practice, PracticeSettings, from_mask
+
+
+def test_unknown_items_are_ignored():
+    settings = PracticeSettings()
+    masks = dict(settings.masks)
+    settings.add_item("chords", 2000000)
+    settings.add_item("chords", -1)
+    settings.remove_item("chords", -1)
+    settings.remove_item("display", -1)
+    settings.add_item("modes", 7)
+    assert settings.masks == masks
+
+    settings.set("chords", [1, 500, -3])
+    assert settings.get("chords") == (1,)
+
+    practice = Practice(settings, "CHORDS", PracticeCatalog("https://assets.invalid"))
+    for _ in range(20):
+        assert practice.generate().answer == 1
+
+
+def test_from_mask_reads_only_the_table_range():
+    # a mask made before the ids were checked
+    assert from_mask(1 << 100000000 | 0b101, 7) == (0, 2)
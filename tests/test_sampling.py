@@ -0,0 +1,98 @@
+"""
+Weighted sampling of practice items
+"""
+import random
+from collections import Counter
+
+from lib.catalog import PracticeCatalog
+from lib.practice import Practice, PracticeSettings
+from lib.sampling import AdaptiveSelector, FenwickTree
+from lib.user import UserStats
+
+
+def prefix_find(weights: list, value: int) -> int:
+    total = 0
+    for i, w in enumerate(weights):
+        total += w
+        if total > value:
+            return i
+    return len(weights)
+
+
+def test_find_matches_prefix_sums():
+    rnd = random.Random(1)
+    for size in (1, 2, 7, 16, 33):
+        weights = [rnd.randrange(5) for _ in range(size)]
+        tree = FenwickTree(size)
+        tree.build(weights)
+        assert tree.total == sum(weights)
+        for value in range(tree.total):
+            assert tree.find(value) == prefix_find(weights, value)
+
+
+def test_set_updates_weights():
+    rnd = random.Random(2)
+    weights = [rnd.randrange(1, 10) for _ in range(20)]
+    tree = FenwickTree(len(weights))
+    tree.build(weights)
+    for _ in range(100):
+        i = rnd.randrange(len(weights))
+        weights[i] = rnd.randrange(10)
+        tree.set(i, weights[i])
+    assert tree.total == sum(weights)
+    for value in range(tree.total):
+        assert tree.find(value) == prefix_find(weights, value)
+
+
+def test_sample_is_proportional():
+    random.seed(3)
+    tree = FenwickTree(4)
+    tree.build([0, 1, 3, 0])
+    counts = Counter(tree.sample() for _ in range(8000))
+    assert set(counts) == {1, 2}
+    assert 2.5 < counts[2] / counts[1] < 3.5
+
+
+def test_selector_follows_settings_and_answers():
+    random.seed(4)
+    table = PracticeCatalog("https://assets.invalid").tables["CHORDS"]
+    settings = PracticeSettings()
+    settings.set("chords", [0, 1])
+    settings.set("chord_inversions", [0])
+    stats = UserStats()
+    selector = AdaptiveSelector(table, settings, stats)
+    assert {selector.sample() for _ in range(200)} == {(0, 0), (1, 0)}
+
+    # a missed item comes up more often than a known one
+    for _ in range(20):
+        stats.result(True, "chords", 0, 0)
+        stats.result(False, "chords", 1, 0)
+    counts = Counter(selector.sample() for _ in range(2000))
+    assert counts[(1, 0)] > 5 * counts[(0, 0)]
+
+    settings.set("chords", [3])
+    assert {selector.sample() for _ in range(50)} == {(3, 0)}
+
+
+def test_no_pick_without_audio_falls_back_to_uniform():
+    catalog = PracticeCatalog("https://assets.invalid")
+    table = catalog.tables["CHORDS"]
+    settings = PracticeSettings()
+    settings.set("chords", [2, 3])
+    settings.set("chord_inversions", [1])
+    # no selected combination has an audio on the host
+    table.exclude(
+        {
+            table.audio[table.index(sd, item, 1)]
+            for sd in range(table.n_scales)
+            for item in (2, 3)
+        }
+    )
+    stats = UserStats()
+    assert AdaptiveSelector(table, settings, stats).sample() is None
+
+    practice = Practice(settings, "CHORDS", catalog, stats)
+    for _ in range(20):
+        item = practice.generate()
+        assert item.answer in (2, 3) and item.answer2 == 1
+        assert item.answer_text in item.keyboard
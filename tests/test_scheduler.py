@@ -0,0 +1,72 @@
+"""
+Per-chat ordering of the handlers
+"""
+import asyncio
+
+from lib.scheduler import ChatScheduler
+
+
+def test_chat_updates_run_in_order():
+    async def main():
+        scheduler = ChatScheduler(max_concurrency=8)
+        done = []
+
+        async def handler(chat_id: int, n: int, delay: float):
+            await asyncio.sleep(delay)
+            done.append((chat_id, n))
+
+        # later updates of a chat are quicker, they still end after earlier ones
+        await asyncio.gather(
+            *[
+                scheduler.run(chat_id, handler(chat_id, n, 0.01 * (5 - n)))
+                for n in range(5)
+                for chat_id in (1, 2)
+            ]
+        )
+        for chat_id in (1, 2):
+            assert [n for c, n in done if c == chat_id] == list(range(5))
+        assert not scheduler.tails
+        assert scheduler.waiting == scheduler.running == 0
+
+    asyncio.run(main())
+
+
+def test_chats_run_in_parallel_up_to_max_concurrency():
+    # created off the event loop, like in Bot.__init__
+    scheduler = ChatScheduler(max_concurrency=3)
+
+    async def main():
+        running = peak = 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(
+            *[scheduler.run(chat_id, handler()) for chat_id in range(10)]
+        )
+        assert peak == 3
+
+    asyncio.run(main())
+
+
+def test_failed_update_does_not_block_the_chat():
+    async def main():
+        scheduler = ChatScheduler()
+
+        async def fail():
+            raise ValueError("handler error")
+
+        async def ok():
+            return "ok"
+
+        results = await asyncio.gather(
+            scheduler.run(1, fail()), scheduler.run(1, ok()), return_exceptions=True
+        )
+        assert isinstance(results[0], ValueError)
+        assert results[1] == "ok"
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+"""
+The bounded cache of chat sessions and of chat states
+"""
+import lib.session
+from lib.session import ChatStates, SessionCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_cache(monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(lib.session, "monotonic", clock)
+    loaded, evicted = [], []
+
+    def loader(chat_id: int) -> dict:
+        loaded.append(chat_id)
+        return {"chat_id": chat_id}
+
+    cache = SessionCache(
+        loader, lambda chat_id, s: evicted.append(chat_id), **kwargs
+    )
+    return cache, clock, loaded, evicted
+
+
+def test_sessions_are_loaded_once(monkeypatch):
+    cache, _, loaded, _ = make_cache(monkeypatch)
+    assert cache[1] is cache[1]
+    assert loaded == [1]
+
+
+def test_least_recently_used_is_evicted(monkeypatch):
+    cache, _, loaded, evicted = make_cache(monkeypatch, max_size=2)
+    cache[1], cache[2]
+    cache[1]
+    cache[3]
+    assert evicted == [2]
+    assert 1 in cache and 3 in cache and 2 not in cache
+    cache[2]
+    assert loaded == [1, 2, 3, 2]
+    assert evicted == [2, 1]
+
+
+def test_idle_sessions_are_evicted(monkeypatch):
+    cache, clock, _, evicted = make_cache(monkeypatch, idle_ttl=60)
+    cache[1]
+    clock.now += 30
+    cache[2]
+    clock.now += 40
+    assert cache.evict() == 1
+    assert evicted == [1]
+    assert len(cache) == 1 and 2 in cache
+
+
+def test_clear_evicts_all(monkeypatch):
+    cache, _, _, evicted = make_cache(monkeypatch, max_size=10)
+    for chat_id in range(5):
+        cache[chat_id]
+    cache.clear()
+    assert len(cache) == 0
+    assert evicted == list(range(5))
+    assert cache.max_size == 10
+
+
+def test_chat_states_drop_the_least_recently_active_chats():
+    states = ChatStates(max_size=2)
+    states.set(1, "PRACTICE")
+    states.set(2, "MENU")
+    assert states.get(1) == "PRACTICE"
+    states.set(3, "STATS")
+    assert len(states) == 2
+    assert states.get(2) is None
+    assert (states.get(1), states.get(3)) == ("PRACTICE", "STATS")
+    # a cancelled chat is forgotten
+    states.set(1, None)
+    assert states.get(1) is None and len(states) == 1
@@ -0,0 +1,50 @@
+"""
+Profiles written to the storage backends read back unchanged
+"""
+import pytest
+
+from lib.storage import JsonStorage, SQLiteStorage, UserStorage
+from lib.user import UserManager
+
+
+def answer_and_configure(manager: UserManager, user_id: int):
+    user = manager.load_user(user_id)
+    manager.record_answer(user_id, user, True, "chords", 0, 0)
+    manager.record_answer(user_id, user, False, "chords", 0, 0)
+    manager.record_answer(user_id, user, True, "chords", 3, 1)
+    manager.record_answer(user_id, user, False, "modes", 2, 0)
+    user.settings.set("chords", [0, 3])
+    manager.settings_changed(user_id, user, "chords")
+    user.settings.set("display", [1])
+    manager.settings_changed(user_id, user, "display")
+    return user
+
+
+def test_incremental_changes_read_back(tmp_path):
+    storage = SQLiteStorage(":memory:")
+    manager = UserManager(storage)
+    user = answer_and_configure(manager, 7)
+    assert not manager.dirty and len(manager.ops) == 6
+    assert manager.flush() == 6
+
+    loaded = UserManager(storage).load_user(7)
+    assert loaded.stats.success_answers == user.stats.success_answers
+    assert loaded.stats.failed_answers == user.stats.failed_answers
+    assert list(loaded.settings.get("chords")) == [0, 3]
+    assert list(loaded.settings.get("display")) == [1]
+
+    # the same profile as a json file
+    json_manager = UserManager(JsonStorage(str(tmp_path)))
+    json_user = answer_and_configure(json_manager, 7)
+    json_manager.flush()
+    assert UserManager.to_profile(7, loaded) == UserManager.to_profile(
+        7, json_manager.load_user(7)
+    )
+    assert UserManager.to_profile(7, loaded) == UserManager.to_profile(7, json_user)
+
+
+def test_only_incremental_storage_applies_changes(tmp_path):
+    with pytest.raises(TypeError):
+        UserStorage()
+    assert not hasattr(JsonStorage(str(tmp_path)), "apply")
+    assert SQLiteStorage(":memory:").incremental
@@ -0,0 +1,80 @@
+"""
+User statistics keep the json profile format of the earlier dict based stats
+"""
+from lib.user import User, UserManager, UserStats
+
+PROFILE = {
+    "success_answers": {
+        "chords": {"maj7": 3, "maj7:root - chord": 2, "maj7:root - notes asc": 1},
+        "modes": {"Dorian": 0, "Dorian:asc": 0},
+    },
+    "failed_answers": {
+        "chords": {"maj7": 1, "maj7:root - chord": 0, "maj7:root - notes asc": 1},
+        "modes": {"Dorian": 2, "Dorian:asc": 2},
+    },
+    "id": 7,
+    "profile": {"user_name": "someone"},
+    "practice_chords": [0, 1, 3],
+    "practice_chord_inversions": [0, 3],
+    "practice_modes": [0, 1, 2, 3, 4, 5, 6],
+    "practice_modes_types": [0],
+    "practice_display": [0, 1],
+}
+
+
+def test_profile_round_trip():
+    user = UserManager.from_profile(7, PROFILE)
+    assert UserManager.to_profile(7, user) == PROFILE
+
+
+def test_unknown_keys_are_kept():
+    success = {
+        "chords": {"maj7": 1, "maj7:weird": 4, "maj13": 2},
+        "modes": {},
+        "intervals": {"P5": 3},
+    }
+    failed = {"chords": {"maj7": 0, "maj7:weird": 1, "maj13": 5}, "modes": {}}
+    stats = UserStats()
+    stats.load(success, failed)
+    assert stats.success_answers == success
+    assert stats.failed_answers == failed
+
+
+def test_result_keys():
+    stats = UserStats()
+    stats.result(False, "chords", 0, 0)
+    assert stats.success_answers == {
+        "chords": {"maj7": 0, "maj7:root - chord": 0},
+        "modes": {},
+    }
+    assert stats.failed_answers == {
+        "chords": {"maj7": 1, "maj7:root - chord": 1},
+        "modes": {},
+    }
+
+
+def test_prepare_stats_after_results():
+    user = User(7, "someone")
+    stats = user.stats
+    stats.load(PROFILE["success_answers"], PROFILE["failed_answers"])
+    # the text as rendered before the counters were kept in arrays
+    assert stats.prepare_stats() == (
+        "chords:\n"
+        "maj7                      right:3 wrong:1\n"
+        "\n"
+        "modes:\n"
+        "Dorian                    right:0 wrong:2\n"
+        "\n"
+    )
+    stats.result(True, "chords", 0, 3)
+    stats.result(False, "modes", 2, 0)
+    # a new item is rendered after the earlier items of its type
+    assert stats.prepare_stats() == (
+        "chords:\n"
+        "maj7                      right:4 wrong:1\n"
+        "\n"
+        "modes:\n"
+        "Dorian                    right:0 wrong:2\n"
+        "Phrygian                  right:0 wrong:1\n"
+        "\n"
+    )
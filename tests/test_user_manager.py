@@ -0,0 +1,134 @@
+"""
+Write-behind of users` changes: nothing is lost while a flush runs or fails
+"""
+import threading
+
+from lib.storage import JsonStorage, SQLiteStorage
+from lib.user import UserManager
+
+
+class BlockingJsonStorage(JsonStorage):
+    """
+    Json files whose saves can be held and failed
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.failures = 0
+
+    def save(self, user_id: int, profile: dict) -> None:
+        self.entered.set()
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        super().save(user_id, profile)
+
+
+class BlockingSQLiteStorage(SQLiteStorage):
+    """
+    An in-memory database whose incremental changes can be held and failed
+    """
+
+    def __init__(self):
+        super().__init__(":memory:")
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.failures = 0
+
+    def apply(self, ops: list) -> None:
+        self.entered.set()
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("database is locked")
+        super().apply(ops)
+
+
+def maj7(user) -> tuple:
+    return (
+        user.stats.success_answers["chords"].get("maj7", 0),
+        user.stats.failed_answers["chords"].get("maj7", 0),
+    )
+
+
+def test_profile_being_saved_is_loaded_from_memory(tmp_path):
+    storage = BlockingJsonStorage(str(tmp_path))
+    manager = UserManager(storage)
+    user = manager.load_user(1)
+    manager.record_answer(1, user, True, "chords", 0, 0)
+    assert manager.dirty == {1: user}
+
+    storage.release.clear()
+    flush = threading.Thread(target=manager.flush)
+    flush.start()
+    assert storage.entered.wait(5)
+    assert not manager.dirty and manager.in_flight == {1: user}
+    # the stored profile is older than the one being written
+    assert manager.load_user(1) is user
+    storage.release.set()
+    flush.join(5)
+
+    assert not manager.in_flight
+    assert maj7(UserManager(storage).load_user(1)) == (1, 0)
+
+
+def test_failed_save_is_written_by_the_next_flush(tmp_path):
+    storage = BlockingJsonStorage(str(tmp_path))
+    manager = UserManager(storage)
+    user = manager.load_user(1)
+    manager.record_answer(1, user, True, "chords", 0, 0)
+    storage.failures = 1
+    assert manager.flush() == 0
+    assert manager.dirty == {1: user} and not manager.in_flight
+    assert manager.load_user(1) is user
+
+    manager.record_answer(1, user, False, "chords", 0, 0)
+    assert manager.flush() == 1
+    assert maj7(UserManager(storage).load_user(1)) == (1, 1)
+
+
+def test_load_waits_for_changes_being_applied():
+    storage = BlockingSQLiteStorage()
+    manager = UserManager(storage)
+    user = manager.load_user(1)
+    manager.record_answer(1, user, True, "chords", 0, 0)
+    assert manager.ops_users == {1}
+
+    storage.release.clear()
+    flush = threading.Thread(target=manager.flush)
+    flush.start()
+    assert storage.entered.wait(5)
+    assert manager.in_flight_ops == {1} and not manager.ops
+
+    loaded = []
+    load = threading.Thread(target=lambda: loaded.append(manager.load_user(1)))
+    load.start()
+    load.join(0.1)
+    # the stored answers are older than the ones being applied
+    assert load.is_alive()
+    storage.release.set()
+    flush.join(5)
+    load.join(5)
+
+    assert maj7(loaded[0]) == (1, 0)
+    assert not manager.in_flight_ops
+
+
+def test_failed_apply_is_retried_before_a_load():
+    storage = BlockingSQLiteStorage()
+    manager = UserManager(storage)
+    user = manager.load_user(1)
+    manager.record_answer(1, user, True, "chords", 0, 0)
+    manager.record_answer(1, user, False, "chords", 0, 0)
+    storage.failures = 1
+    assert manager.flush() == 0
+    assert len(manager.ops) == 2 and manager.ops_users == {1}
+
+    # the load flushes the requeued answers first
+    assert maj7(manager.load_user(1)) == (1, 1)
+    assert not manager.ops and not manager.ops_users
@@ -0,0 +1,286 @@
+"""
+Aggregate practice statistics across all users` profiles (the users/ directory)
+
+Streams the json profiles through a pool of processes and reports accuracy
+per item, a breakdown per variant (chord inversion, mode direction) and users
+counts. The stats of every profile are kept with its signature, per shard
+of users, so a rerun re-reads only changed profiles.
+
+Usage: python -m tools.analytics [--src users] [--state cache/analytics] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, time
+
+from lib.storage import JsonStorage, atomic_write
+
+SHARDS = 256
+
+
+def scan(src: str, shards: int = SHARDS) -> list:
+    """
+    Signatures of the profiles by shard: [{user_id: [mtime_ns, size]}, ...]
+    """
+    files = [{} for _ in range(shards)]
+    with os.scandir(src) as it:
+        for entry in it:
+            if not entry.name.lstrip("-").isdigit() or not entry.is_file():
+                continue
+            st = entry.stat()
+            user_id = int(entry.name)
+            files[user_id % shards][entry.name] = [st.st_mtime_ns, st.st_size]
+    return files
+
+
+def empty_stats() -> dict:
+    return {"users": 0, "answered": 0, "broken": 0, "answers": {}}
+
+
+def profile_stats(profile: dict, variant_keys: dict) -> dict:
+    """
+    Stats of a single profile.
+    Counters are {name: {key: [right, wrong, users]}} where a key is an item
+    or "item:variant", and ":variant" counts users who answered a variant
+    (its right and wrong answers are summed up in the report).
+    variant_keys caches key -> its ":variant" key or None, keys repeat across users.
+    """
+    success = profile["success_answers"]
+    failed = profile["failed_answers"]
+    stats = empty_stats()
+    stats["users"] = 1
+    for name in set(success) | set(failed):
+        counters = {}
+        right_answers = success.get(name, {})
+        variants = set()
+        for answers, i in ((right_answers, 0), (failed.get(name, {}), 1)):
+            for key, n in answers.items():
+                if not n:
+                    continue
+                c = counters.get(key)
+                if c is None:
+                    # a user is counted once per key
+                    c = counters[key] = [0, 0, 1]
+                c[i] += n
+                variant = variant_keys.get(key, 0)
+                if variant == 0:
+                    _, sep, variant = key.partition(":")
+                    variant = variant_keys[key] = f":{variant}" if sep else None
+                if variant is not None:
+                    variants.add(variant)
+        for variant in variants:
+            counters[variant] = [0, 0, 1]
+        if counters:
+            stats["answers"][name] = counters
+            stats["answered"] = 1
+    return stats
+
+
+def aggregate(src: str, user_ids: list) -> dict:
+    """
+    Stats of each of the given users` profiles: {user_id: stats},
+    None for a profile removed since the scan
+    """
+    storage = JsonStorage(src)
+    variant_keys = {}
+    result = {}
+    for user_id in user_ids:
+        try:
+            profile = storage.load(int(user_id))
+            stats = None if profile is None else profile_stats(profile, variant_keys)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            stats = dict(empty_stats(), broken=1)
+        result[user_id] = stats
+    return result
+
+
+def merge(total: dict, stats: dict, sign: int = 1) -> None:
+    """
+    Add stats to the total stats, or subtract them with sign -1
+    """
+    for k in ("users", "answered", "broken"):
+        total[k] += sign * stats[k]
+    for name, counters in stats["answers"].items():
+        target = total["answers"].setdefault(name, {})
+        for key, (right, wrong, users) in counters.items():
+            c = target.setdefault(key, [0, 0, 0])
+            c[0] += sign * right
+            c[1] += sign * wrong
+            c[2] += sign * users
+            if c == [0, 0, 0]:
+                del target[key]
+        if not target:
+            del total["answers"][name]
+
+
+def load_shard(state: str, shard: int) -> dict:
+    try:
+        with open(os.path.join(state, f"shard_{shard:03}.json"), "r") as f:
+            saved = json.load(f)
+        if "profiles" in saved:
+            return saved
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def save_shard(state: str, shard: int, saved: dict) -> None:
+    atomic_write(os.path.join(state, f"shard_{shard:03}.json"), json.dumps(saved))
+
+
+def run(src: str, state: str, workers: int = None, shards: int = SHARDS) -> tuple:
+    """
+    Aggregate all profiles, re-reading only changed profiles: the stats
+    of a changed or removed profile are subtracted from its shard`s stats
+    and the new ones are added.
+    Return (total stats, profiles signatures by shard, number of re-read profiles)
+    """
+    os.makedirs(state, exist_ok=True)
+    files = scan(src, shards)
+    total = empty_stats()
+
+    saved_shards = {}
+    changed = {}
+    for shard, shard_files in enumerate(files):
+        saved = load_shard(state, shard)
+        if saved is None:
+            saved = {"files": {}, "profiles": {}, "stats": empty_stats()}
+        stale = [
+            user_id
+            for user_id, signature in saved["files"].items()
+            if shard_files.get(user_id) != signature
+        ]
+        for user_id in stale:
+            old = saved["profiles"].pop(user_id, None)
+            if old is not None:
+                merge(saved["stats"], old, -1)
+        ids = [i for i, sig in shard_files.items() if saved["files"].get(i) != sig]
+        if stale or ids:
+            saved["files"] = shard_files
+            saved_shards[shard] = saved
+            changed[shard] = ids
+        else:
+            merge(total, saved["stats"])
+
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(
+            aggregate, [src] * len(changed), [changed[shard] for shard in changed]
+        )
+        for shard, profiles in zip(changed, results):
+            saved = saved_shards[shard]
+            for user_id, stats in profiles.items():
+                if stats is not None:
+                    saved["profiles"][user_id] = stats
+                    merge(saved["stats"], stats)
+            save_shard(state, shard, saved)
+            merge(total, saved["stats"])
+    return total, files, sum(len(ids) for ids in changed.values())
+
+
+def accuracy(right: int, wrong: int) -> float:
+    return round(right / (right + wrong), 4) if right + wrong else 0.0
+
+
+def report(total: dict, files: list, active_days: float = 7.0) -> dict:
+    """
+    A report of the total stats, items sorted from the most often missed
+    """
+    since = (time() - active_days * 86400) * 1e9
+    practice = {}
+    for name, counters in sorted(total["answers"].items()):
+        # right and wrong answers of a variant are those of its combinations
+        for key, (right, wrong, _) in list(counters.items()):
+            _, sep, variant = key.partition(":")
+            if sep and key[0] != ":":
+                c = counters[f":{variant}"]
+                c[0] += right
+                c[1] += wrong
+        items, variants, combinations = [], [], []
+        for key, (right, wrong, users) in counters.items():
+            row = {
+                "accuracy": accuracy(right, wrong),
+                "right": right,
+                "wrong": wrong,
+                "users": users,
+            }
+            if key.startswith(":"):
+                variants.append(dict(row, variant=key[1:]))
+            elif ":" in key:
+                combinations.append(dict(row, combination=key))
+            else:
+                items.append(dict(row, item=key))
+        for rows in (items, variants, combinations):
+            rows.sort(key=lambda r: (r["accuracy"], -r["wrong"]))
+        practice[name] = {
+            "items": items,
+            "variants": variants,
+            "combinations": combinations,
+        }
+    return {
+        "users": total["users"],
+        "users_answered": total["answered"],
+        "users_active": sum(
+            1 for shard in files for mtime, _ in shard.values() if mtime >= since
+        ),
+        "active_days": active_days,
+        "broken_profiles": total["broken"],
+        "practice": practice,
+    }
+
+
+def print_report(data: dict) -> None:
+    print(
+        f"users: {data['users']}, answered: {data['users_answered']}, "
+        f"active in {data['active_days']:g} days: {data['users_active']}, "
+        f"broken profiles: {data['broken_profiles']}"
+    )
+    for name, tables in data["practice"].items():
+        for kind, column in (("items", "item"), ("variants", "variant")):
+            print(f"\n{name} {kind}:")
+            print(
+                "{:<30} {:>9} {:>10} {:>10} {:>8}".format(
+                    column, "accuracy", "right", "wrong", "users"
+                )
+            )
+            for row in tables[kind]:
+                print(
+                    "{:<30} {:>8.1f}% {:>10} {:>10} {:>8}".format(
+                        row[column],
+                        row["accuracy"] * 100,
+                        row["right"],
+                        row["wrong"],
+                        row["users"],
+                    )
+                )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--src", default="users", help="json profiles directory")
+    parser.add_argument(
+        "--state", default="cache/analytics", help="per profile results directory"
+    )
+    parser.add_argument("--workers", type=int, help="number of processes")
+    parser.add_argument("--active-days", type=float, default=7.0)
+    parser.add_argument("--json", action="store_true", help="print a json report")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    total, files, reread = run(args.src, args.state, args.workers)
+    data = report(total, files, args.active_days)
+    if args.json:
+        json.dump(data, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(data)
+    profiles = sum(len(shard) for shard in files)
+    print(
+        f"\n{reread} of {profiles} profiles re-read in {perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Microbenchmarks of the hot library paths
+
+Usage: python -m tools.benchmark [--output run.json] [--compare base.json]
+"""
+import argparse
+import json
+import platform
+import tempfile
+import timeit
+from datetime import datetime
+from random import Random
+
+from lib.catalog import PracticeCatalog
+from lib.practice import Practice, PracticeSettings
+from lib.storage import JsonStorage, SQLiteStorage
+from lib.theory import CHORD_INVERSIONS, CHORDS, MODES, MODES_TYPES
+from lib.user import User, UserManager
+
+# profile size -> share of (item, variant) combinations the user has answered
+PROFILE_SIZES = {"new": 0.0, "typical": 0.3, "full": 1.0}
+
+
+def make_user(size: str, user_id: int = 1) -> User:
+    """
+    A user with stats of a given profile size
+    """
+    user = User(user_id, "bench")
+    rnd = Random(user_id)
+    for name, items, variants in (
+        ("chords", CHORDS, CHORD_INVERSIONS),
+        ("modes", MODES, MODES_TYPES),
+    ):
+        for item in items:
+            for variant in variants:
+                if rnd.random() < PROFILE_SIZES[size]:
+                    for _ in range(rnd.randrange(1, 20)):
+                        user.stats.result(rnd.random() < 0.7, name, item, variant)
+    return user
+
+
+def benchmarks(workdir: str) -> dict:
+    """
+    Benchmark name -> a function to time
+    """
+    catalog = PracticeCatalog("https://assets.invalid")
+    settings = PracticeSettings()
+    settings.set("chords", list(CHORDS))
+    settings.set("chord_inversions", list(CHORD_INVERSIONS))
+    chords = Practice(settings, "CHORDS", catalog)
+    modes = Practice(settings, "MODES", catalog)
+    stats_user = make_user("typical")
+    adaptive = Practice(settings, "CHORDS", catalog, make_user("typical", 2).stats)
+
+    bench = {
+        "practice.generate.chords": chords.generate,
+        "practice.generate.modes": modes.generate,
+        "practice.generate.adaptive": adaptive.generate,
+        "stats.result": lambda: stats_user.stats.result(True, "chords", 0, 0),
+        "settings.print_chord_settings": settings.print_chord_settings,
+        "settings.print_modes_settings": settings.print_modes_settings,
+    }
+
+    for size in PROFILE_SIZES:
+        user = make_user(size)
+        # a cached text, nothing changed since the last call
+        bench[f"stats.prepare_stats.{size}"] = user.stats.prepare_stats
+        # an answer before each call: the changed line is rendered again
+        answered = make_user(size)
+        bench[f"stats.result_prepare_stats.{size}"] = lambda stats=answered.stats: (
+            stats.result(True, "chords", 0, 0),
+            stats.prepare_stats(),
+        )
+
+        for backend, storage in (
+            ("json", JsonStorage(f"{workdir}/{size}")),
+            ("sqlite", SQLiteStorage(f"{workdir}/{size}.db")),
+        ):
+            um = UserManager(storage)
+            um.save_user(1, user)
+            bench[f"user_manager.save_user.{backend}.{size}"] = (
+                lambda um=um, user=user: um.save_user(1, user)
+            )
+            bench[f"user_manager.load_user.{backend}.{size}"] = (
+                lambda um=um: um.load_user(1)
+            )
+    return bench
+
+
+def measure(fn, repeat: int = 5, min_time: float = 0.2) -> dict:
+    """
+    Time a function, the best of several runs
+    """
+    timer = timeit.Timer(fn)
+    loops, _ = timer.autorange()
+    loops = max(1, int(loops * min_time / 0.2))
+    times = timer.repeat(repeat, loops)
+    return {
+        "ns_per_call": round(min(times) / loops * 1e9, 1),
+        "loops": loops,
+        "repeat": repeat,
+    }
+
+
+def compare(results: dict, base: dict) -> None:
+    """
+    Print a comparison of results with a previous run
+    """
+    print("{:<45} {:>14} {:>14} {:>8}".format("benchmark", "base ns", "ns", "ratio"))
+    for name, res in results.items():
+        old = base.get("results", {}).get(name)
+        if old is None:
+            print("{:<45} {:>14} {:>14.1f}".format(name, "-", res["ns_per_call"]))
+            continue
+        ratio = res["ns_per_call"] / old["ns_per_call"] if old["ns_per_call"] else 0
+        print(
+            "{:<45} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+                name, old["ns_per_call"], res["ns_per_call"], ratio
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write results to a json file")
+    parser.add_argument("--compare", help="compare with results of a previous run")
+    parser.add_argument("--filter", default="", help="run benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, fn in benchmarks(workdir).items():
+            if args.filter in name:
+                results[name] = measure(fn, args.repeat)
+                print("{:<45} {:>14.1f} ns".format(name, results[name]["ns_per_call"]))
+
+    run = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
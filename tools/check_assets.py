@@ -0,0 +1,131 @@
+"""
+Check every practice asset exists on the assets host and write an assets manifest
+
+The bot loads the manifest at startup and does not pick practice items
+whose assets are missing. Assets are checked with concurrent HEAD requests
+over keep-alive connections.
+
+Usage: python -m tools.check_assets [--host URL] [--output cache/assets.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from lib.catalog import PracticeCatalog
+from lib.storage import atomic_write
+
+# responses of assets that do not exist, other errors do not exclude an asset
+MISSING_STATUSES = (404, 410)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections, one per worker thread and host
+    """
+
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connections = self.local.__dict__.setdefault("connections", {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def head(self, url: str) -> tuple:
+        """
+        HEAD an url, return (status, etag), Last-Modified stands for a missing etag
+        """
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        # a kept-alive connection may have been closed by the server, retry once
+        for attempt in range(2):
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("HEAD", path or "/")
+                response = conn.getresponse()
+                response.read()
+                etag = response.getheader("ETag")
+                return response.status, etag or response.getheader("Last-Modified")
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self.local.connections.pop((parts.scheme, parts.netloc), None)
+                if attempt:
+                    raise
+
+
+def check(host: str, workers: int = 32, timeout: float = 10.0) -> dict:
+    """
+    Check all assets of the practice catalog, return a manifest
+    """
+    pool = ConnectionPool(timeout)
+    urls = list(PracticeCatalog(host).urls())
+
+    def head(url: str) -> tuple:
+        try:
+            return (url, *pool.head(url), None)
+        except (http.client.HTTPException, OSError) as e:
+            return url, None, None, str(e)
+
+    missing, errors, etags = [], {}, {}
+    with ThreadPoolExecutor(workers, thread_name_prefix="CheckAssets") as executor:
+        for url, status, etag, error in executor.map(head, urls):
+            if status in MISSING_STATUSES:
+                missing.append(url)
+            elif error is not None or status >= 400:
+                # unknown (e.g. HEAD is not allowed), the asset is not excluded
+                errors[url] = error or f"HTTP {status}"
+            elif etag:
+                etags[url] = etag
+
+    return {
+        "host": host,
+        "checked": datetime.now().isoformat(timespec="seconds"),
+        "total": len(urls),
+        "missing": missing,
+        "errors": errors,
+        "etags": etags,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", help="assets host, HOST of the config by default")
+    parser.add_argument("--output", default="cache/assets.json")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    args = parser.parse_args()
+
+    host = args.host
+    if host is None:
+        with open("./config/settings.json", "r") as f:
+            host = json.load(f)["HOST"]
+
+    manifest = check(host, args.workers, args.timeout)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    atomic_write(args.output, json.dumps(manifest, indent=2))
+
+    print(
+        f"checked {manifest['total']} assets on {host}: "
+        f"{len(manifest['missing'])} missing, {len(manifest['errors'])} errors"
+    )
+    for url in manifest["missing"][:20]:
+        print(f"missing {url}", file=sys.stderr)
+    if manifest["missing"] or manifest["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
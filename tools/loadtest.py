@@ -0,0 +1,374 @@
+"""
+A load test of the bot against a local stand-in for the Telegram Bot API
+
+Starts a fake Bot API server, runs the bot against it and drives synthetic users
+through the bot`s conversation (start, practice, answers, stats, settings).
+Reports throughput, end-to-end latency and API calls per interaction.
+
+Usage: python -m tools.loadtest [--users 1000] [--concurrency 100] [--output run.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+from urllib.parse import parse_qs
+
+TOKEN = "123456:LOADTESTLOADTESTLOADTESTLOADTEST123"
+ANSWER = None
+
+
+def scenario() -> list:
+    """
+    Messages of a synthetic user, ANSWER is replaced with a button of the last keyboard
+    """
+    chord = random.randrange(12)
+    return [
+        "/start",
+        "PRACTICE",
+        "CHORDS",
+        ANSWER,
+        "NEXT",
+        ANSWER,
+        "MENU",
+        "PRACTICE",
+        "MODES",
+        ANSWER,
+        "MENU",
+        "STATS",
+        "MENU",
+        "SETTINGS",
+        "CHORDS",
+        f"/add_0{chord}",
+        f"/remove_0{chord}",
+        "BACK",
+        "SETTINGS",
+        "DISPLAY",
+        "/hide_01",
+        "/show_01",
+        "BACK",
+    ]
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict:
+    """
+    Fields of a multipart/form-data request (e.g. sendMediaGroup)
+    """
+    message = BytesParser().parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    return {
+        part.get_param("name", header="Content-Disposition"): part.get_payload(
+            decode=True
+        ).decode()
+        for part in message.get_payload()
+    }
+
+
+class FakeTelegram:
+    """
+    A stand-in for the Telegram Bot API: serves getUpdates from a queue,
+    answers send and delete methods and notifies users about keyboards sent to them
+    """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Keyword arguments:
+        latency -- an artificial delay of every API response (seconds)
+        """
+        self.latency = latency
+        self.updates = queue.Queue()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.waiters = {}
+        self.loop = None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/bot"
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def push(self, chat_id: int, text: str) -> None:
+        """
+        Queue a user`s message for getUpdates
+        """
+        self.updates.put(
+            {
+                "update_id": self.new_id(),
+                "message": {
+                    "message_id": self.new_id(),
+                    "date": int(time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "load"},
+                    "text": text,
+                },
+            }
+        )
+
+    def get_updates(self, data: dict) -> list:
+        timeout = min(float(data.get("timeout") or 0), 1.0)
+        result = []
+        try:
+            result.append(self.updates.get(timeout=timeout))
+            while len(result) < 100:
+                result.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return result
+
+    def message(self, method: str, data: dict):
+        """
+        Build a result of a send method
+        """
+        chat_id = int(data.get("chat_id", 0))
+        msg = {
+            "message_id": self.new_id(),
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        if method == "sendAudio":
+            msg["audio"] = {"file_id": f"A{msg['message_id']}", "file_unique_id": "a"}
+            msg["audio"]["duration"] = 1
+        elif method == "sendPhoto":
+            size = {"file_id": f"P{msg['message_id']}", "file_unique_id": "p"}
+            msg["photo"] = [dict(size, width=1, height=1)]
+        elif method == "sendMediaGroup":
+            media = data.get("media", [])
+            if isinstance(media, str):
+                media = json.loads(media)
+            group = []
+            for _ in media:
+                m = dict(msg, message_id=self.new_id())
+                size = {"file_id": f"P{m['message_id']}", "file_unique_id": "p"}
+                m["photo"] = [dict(size, width=1, height=1)]
+                group.append(m)
+            return group
+        elif method == "sendMessage":
+            msg["text"] = data.get("text", "")
+            markup = data.get("reply_markup")
+            if markup:
+                if isinstance(markup, str):
+                    markup = json.loads(markup)
+                self.keyboard(chat_id, markup.get("keyboard"))
+        return msg
+
+    def keyboard(self, chat_id: int, keyboard: list) -> None:
+        """
+        Notify a waiting user that the reply of an interaction is complete
+        """
+        future = self.waiters.pop(chat_id, None)
+        if future is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(
+                lambda: future.done() or future.set_result(keyboard)
+            )
+
+    def call(self, method: str, data: dict):
+        with self.lock:
+            self.calls[method] += 1
+        if method == "getUpdates":
+            return self.get_updates(data)
+        if self.latency:
+            threading.Event().wait(self.latency)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        if method.startswith("send"):
+            return self.message(method, data)
+        return True
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                content_type = self.headers.get("Content-Type", "")
+                try:
+                    if "json" in content_type:
+                        data = json.loads(body or b"{}")
+                    elif "multipart" in content_type:
+                        data = parse_multipart(content_type, body)
+                    else:
+                        data = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                except ValueError:
+                    data = {}
+                result = fake.call(self.path.rsplit("/", 1)[-1], data)
+                response = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+async def run_user(
+    fake: FakeTelegram, chat_id: int, latencies: list, timeout: float
+) -> int:
+    """
+    Drive a synthetic user through the scenario, return the number of failed steps
+    """
+    loop = asyncio.get_running_loop()
+    keyboard = None
+    failed = 0
+    for text in scenario():
+        if text is ANSWER:
+            # buttons are serialized as {"text": ...} by python-telegram-bot
+            buttons = [
+                b["text"] if isinstance(b, dict) else b
+                for row in keyboard or []
+                for b in row
+            ]
+            text = random.choice(buttons) if buttons else "maj7"
+        future = loop.create_future()
+        fake.waiters[chat_id] = future
+        start = perf_counter()
+        fake.push(chat_id, text)
+        try:
+            keyboard = await asyncio.wait_for(future, timeout)
+            latencies.append(perf_counter() - start)
+        except asyncio.TimeoutError:
+            fake.waiters.pop(chat_id, None)
+            failed += 1
+    return failed
+
+
+async def drive(fake: FakeTelegram, users: int, concurrency: int, timeout: float):
+    """
+    Run all synthetic users, at most concurrency at a time
+    """
+    fake.loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def user(chat_id: int) -> int:
+        async with semaphore:
+            return await run_user(fake, chat_id, latencies, timeout)
+
+    failed = await asyncio.gather(*[user(100000 + i) for i in range(users)])
+    return latencies, sum(failed)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bot_settings(fake: FakeTelegram, workdir: str, limits: bool = False) -> dict:
+    """
+    The bot`s config pointed at the fake Bot API and a temporary directory,
+    Telegram`s rate limits of the config are kept if limits is set
+    """
+    with open("./config/settings.json", "r") as f:
+        settings = json.load(f)
+    settings["TOKEN"] = TOKEN
+    settings["HOST"] = "https://assets.invalid"
+    settings["logger"].update(
+        {"path": workdir, "console": 0, "level": 30, "name_date_format": ""}
+    )
+    settings.setdefault("updates", {}).update(
+        {"mode": "polling", "api_url": fake.url}
+    )
+    settings.setdefault("storage", {}).update(
+        {"path": os.path.join(workdir, "users"), "database": ":memory:"}
+    )
+    settings.setdefault("sessions", {})["active_users"] = os.path.join(
+        workdir, "active.json"
+    )
+    settings.setdefault("media", {}).update(
+        {"file_ids": os.path.join(workdir, "ids.json"), "warm": False}
+    )
+    if not limits:
+        # the fake server has no rate limits, the bot is measured at full speed
+        settings.setdefault("outbound", {}).update({"rate": 0, "chat_rate": 0})
+    return settings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="API latency, s")
+    parser.add_argument(
+        "--limits", action="store_true", help="keep the config`s rate limits"
+    )
+    parser.add_argument("--output", help="write the report to a json file")
+    args = parser.parse_args()
+
+    # the bot is imported late: its modules log through the logger it configures
+    from lib.bot import Bot
+
+    fake = FakeTelegram(args.latency)
+    fake.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = Bot(bot_settings(fake, workdir, args.limits))
+        bot.start_bot()
+        fake.calls.clear()
+        start = perf_counter()
+        try:
+            latencies, failed = asyncio.run(
+                drive(fake, args.users, args.concurrency, args.timeout)
+            )
+        finally:
+            elapsed = perf_counter() - start
+            bot.stop_bot()
+            fake.stop()
+
+    calls = dict(fake.calls)
+    calls.pop("getUpdates", None)
+    interactions = len(latencies)
+    report = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "rate_limits": args.limits,
+        "interactions": interactions,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "throughput": round(interactions / elapsed, 1) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "api_calls_per_interaction": round(
+            sum(calls.values()) / interactions if interactions else 0.0, 2
+        ),
+        "api_calls": calls,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
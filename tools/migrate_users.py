@@ -0,0 +1,70 @@
+"""
+Import users` json profiles (the users/ directory) into an SQLite database
+
+Usage: python -m tools.migrate_users [--src users] [--database users/users.db]
+"""
+import argparse
+import sys
+
+from lib.storage import JsonStorage, SQLiteStorage
+
+
+def save_batch(target: SQLiteStorage, batch: list) -> int:
+    """
+    Save a batch of profiles in a transaction, return the number of saved users.
+    If a profile lacks a key the batch is saved one by one, skipping such profiles.
+    """
+    try:
+        target.save_many(batch)
+        return len(batch)
+    except (KeyError, TypeError, AttributeError):
+        pass
+    saved = 0
+    for user_id, profile in batch:
+        try:
+            target.save(user_id, profile)
+            saved += 1
+        except (KeyError, TypeError, AttributeError) as e:
+            print(f"skip broken profile {user_id}: {e!r}", file=sys.stderr)
+    return saved
+
+
+def migrate(src: str, database: str, batch_size: int = 1000) -> int:
+    """
+    Copy all json profiles into the database, return the number of imported users
+    """
+    source = JsonStorage(src)
+    target = SQLiteStorage(database)
+    imported = 0
+    batch = []
+    try:
+        for user_id in source.user_ids():
+            try:
+                profile = source.load(user_id)
+            except ValueError as e:
+                print(f"skip broken profile {user_id}: {e}", file=sys.stderr)
+                continue
+            batch.append((user_id, profile))
+            if len(batch) >= batch_size:
+                imported += save_batch(target, batch)
+                batch = []
+        if batch:
+            imported += save_batch(target, batch)
+    finally:
+        target.close()
+    return imported
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--src", default="users", help="json profiles directory")
+    parser.add_argument(
+        "--database", default="users/users.db", help="SQLite database path"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    print(f"imported {migrate(args.src, args.database, args.batch_size)} users")
+
+
+if __name__ == "__main__":
+    main()